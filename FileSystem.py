@@ -1,17 +1,57 @@
-from basic import AcquireLock, ReleaseLock, Decode, FileSystem, HELP_MSG
-from core import Command, SysInit
+from basic import AcquireLock, ReleaseLock, Decode, Dir, File, FileSystem, BlockRuns, HELP_MSG, BLOCK_AMT, BLOCK_SIZE, BLOCK_STR, \
+    BLOCK_END, FAT_END_FLAG
+from core import Command, SysInit, AllFiles, SNAP_PREFIX
+from journal import Journal, ReadJournal
+from profiling import PROFILER
+import metrics
 from functools import wraps
-from threading import Thread
-from time import sleep
+from contextlib import redirect_stdout
+from io import StringIO
+from array import array
+from threading import Thread, Lock
+from time import sleep, perf_counter
 from os import system
+import argparse
 import signal
 import pickle
+import struct
+import copy
+import gc
+import os
+import sys as _sys
 
 
 PATH = './'
-SYS_SAVE_NAME = 'FileSysSim.pickle'
+SYS_SAVE_NAME = 'FileSysSim.img'
+JOURNAL_NAME = 'FileSysSim.journal'
+PROFILE_NAME = 'FileSysSim.prof'
+BATCH_OUTPUT_SIZE = 64 * 1024  # 批量执行时输出缓冲区的大小
+BATCH_SAVE_INTERVAL = 10  # 批量执行时每隔多少秒保存一次
 QUIT_FLAG = False
 
+# 镜像文件格式：
+# 超级块      0 ~ BLOCK_OFFSET              魔数、版本、块大小、块数、元数据区的位置和长度、当前的表区
+# 块区域      BLOCK_OFFSET ~ TABLE_OFFSET   所有盘块，按盘块号顺序排列
+# 表区        TABLE_OFFSET ~ META_OFFSET    两个表区，各存一份FAT表、引用计数、盘块数据长度和位示图，每项的位置固定，按本机字节序存放
+# 元数据区    META_OFFSET ~                 空闲盘块数等计数、目录树、快照、去重索引
+# 每次保存时只把与另一个表区现有内容不同的部分写入另一个表区，新的元数据写在不与原元数据重叠的位置（META_OFFSET处或原元数据之后），
+# 写完后超级块再指向新的表区和元数据
+IMAGE_MAGIC = b'FSSIMIMG'
+IMAGE_VERSION = 2  # 版本1的镜像文件没有表区，位示图、FAT表和盘块数据长度都序列化在元数据中
+SUPER_BLOCK = struct.Struct('<8sIIIQQI')
+BLOCK_OFFSET = 64 * 1024  # 与mmap的分配粒度对齐，块区域可以直接映射
+TABLE_OFFSET = BLOCK_OFFSET + BLOCK_AMT * BLOCK_SIZE
+# 表区中依次为FAT表、引用计数、盘块数据长度、位示图，各部分的长度
+TABLE_PARTS = (2 * (BLOCK_END + 1), 4 * (FAT_END_FLAG + 1), 2 * (BLOCK_END + 1), (FAT_END_FLAG + 1) // 8)
+TABLE_SIZE = sum(TABLE_PARTS)
+TABLE_CHUNK = 4 * 1024  # 比较和写入表区的单位
+META_OFFSET = TABLE_OFFSET + 2 * TABLE_SIZE
+
+# 保存锁，保证同一时间只进行一次保存
+SaveLock = Lock()
+# 保存的统计信息：保存次数、没有修改而跳过的次数、上次保存用时、上次及最长的持有写锁时间（秒）
+SAVE_STATS = {'count': 0, 'skipped': 0, 'LastDuration': 0.0, 'LastLockHold': 0.0, 'MaxLockHold': 0.0}
+
 
 def running_in_thread(func):
     """将此装饰器应用到需要在子线程运行的函数上.函数在调用的时候会运行在单独的线程中"""
@@ -51,35 +91,321 @@ signal.signal(signal.SIGINT, my_handler)  # 读取Ctrl+c信号
 
 
 def SaveSys(sys: FileSystem):
-    """将文件系统类保存"""
-    AcquireLock()
-    with open(PATH + SYS_SAVE_NAME, 'wb') as f:
-        pickle.dump(sys, f)
-    ReleaseLock()
+    """
+    将文件系统保存为镜像文件，没有修改过时不保存
+
+    只在拍下快照时短暂持有写锁，序列化元数据和写入镜像文件时其他操作可以继续进行
+    """
+    path = os.path.abspath(PATH + SYS_SAVE_NAME)
+
+    # 同一时间只进行一次保存
+    with SaveLock:
+        Start = perf_counter()
+        # 持有卷的写锁时没有正在执行的操作，快照中恰好包含序号不大于 Snapshot['Seq'] 的操作
+        AcquireLock()
+        try:
+            Snapshot = TakeSnapshot(sys, path) if sys.ImagePath != path or sys.IsDirty() else None
+        finally:
+            ReleaseLock()
+        LockHold = perf_counter() - Start
+
+        if Snapshot is None:
+            SAVE_STATS['skipped'] += 1
+            if metrics.ENABLED:
+                metrics.Count('save.skipped')
+            return
+
+        try:
+            WriteImage(Snapshot, path)
+        except Exception:
+            # 保存失败，重新标记为修改过，下次保存时再写入
+            AcquireLock()
+            sys.Storage.Dirty |= Snapshot['Dirty']
+            sys.MetaDirty = True
+            ReleaseLock()
+            raise
+
+        sys.ImagePath = path
+        sys.JournalSeq = Snapshot['Seq']
+        # 镜像文件中已包含的操作可以从日志中删除
+        if sys.Journal is not None:
+            sys.Journal.Checkpoint(Snapshot['Seq'])
+        SAVE_STATS['count'] += 1
+        SAVE_STATS['LastDuration'] = perf_counter() - Start
+        SAVE_STATS['LastLockHold'] = LockHold
+        SAVE_STATS['MaxLockHold'] = max(SAVE_STATS['MaxLockHold'], LockHold)
+        if metrics.ENABLED:
+            metrics.Count('save.blocks', len(Snapshot['Dirty']))
+            metrics.Observe('save.duration', SAVE_STATS['LastDuration'])
+            metrics.Observe('save.lock_hold', LockHold)
 
 
 def LoadSys() -> FileSystem:
-    """加载文件系统类"""
+    """加载文件系统镜像"""
     try:
-        with open(PATH + SYS_SAVE_NAME, 'rb') as f:
-            sys = pickle.load(f)
-            return sys
+        return ReadImage(PATH + SYS_SAVE_NAME)
     except FileNotFoundError:
         raise FileNotFoundError('未找到保存的文件系统')
 
 
-def SysInitialization() -> FileSystem:
-    """初始化文件系统"""
+def TakeSnapshot(sys: FileSystem, path: str) -> dict:
+    """
+    拍下文件系统此刻的快照，调用前需要持有写锁
+
+    若镜像文件就是上次保存的文件，只复制上次保存之后修改过的盘块，否则复制整个块区域；
+    表区的内容整体复制，由 WriteImage 与镜像文件中现有的内容比较；元数据只复制不序列化，由 WriteImage 在释放写锁后序列化
+    """
+    Full = sys.ImagePath != path or not os.path.exists(path)
+    if Full:
+        sys.ImageTables = [None, None]
+    Dirty, sys.Storage.Dirty = sys.Storage.Dirty, set()
+    sys.MetaDirty = False
+
+    # 块区域私有映射到镜像文件时，内存中的修改不会写回镜像文件，与不映射时一样复制修改过的盘块
+    if Full:
+        Blocks = [(BLOCK_STR, bytes(sys.Storage.View))]
+    else:
+        Blocks = [(Start, bytes(sys.Storage.ReadRaw(Start, Amount))) for Start, Amount in BlockRuns(sorted(Dirty))]
+
+    Seq = sys.Journal.Seq if sys.Journal is not None else sys.JournalSeq
+    return {
+        'Seq': Seq,
+        'Full': Full,
+        'Dirty': Dirty,
+        'Blocks': Blocks,
+        'Tables': PackTables(sys),
+        'ImageTables': sys.ImageTables,
+        'Meta': FreezeMeta(sys, Seq),
+    }
+
+
+def PackTables(sys: FileSystem) -> bytes:
+    """将FAT表、引用计数、盘块数据长度和位示图连接成表区的内容，调用前需要持有锁"""
+    return b''.join((sys.FAT.FAT.tobytes(), sys.BitMap.Refs.tobytes(), sys.Storage.Length.tobytes(),
+                     bytes(sys.BitMap.BitMap)))
+
+
+def UnpackTables(sys: FileSystem, data: bytes) -> None:
+    """由表区的内容恢复FAT表、引用计数、盘块数据长度和位示图"""
+    Parts, Start = [], 0
+    for Size in TABLE_PARTS:
+        Parts.append(data[Start:Start + Size])
+        Start += Size
+    sys.FAT.FAT, sys.BitMap.Refs = array('H', Parts[0]), array('I', Parts[1])
+    sys.Storage.Length, sys.BitMap.BitMap = array('H', Parts[2]), bytearray(Parts[3])
+
+
+def FreezeMeta(sys: FileSystem, seq: int) -> dict:
+    """
+    复制此刻的元数据，调用前需要持有写锁
+
+    位示图只复制计数，数组在表区中；去重索引复制其中的字典，目录树只复制每个目录和文件的属性字典，
+    都比序列化快得多；快照是只读的，只复制快照名到根目录的映射
+    """
+    # 复制目录树时会新建大量对象，暂停垃圾回收，避免持有写锁期间触发一次完整的回收
+    Collect = gc.isenabled()
+    gc.disable()
     try:
-        return LoadSys()
+        Tree = FreezeTree(sys.RootDir)
+    finally:
+        if Collect:
+            gc.enable()
+
+    Dedup = copy.copy(sys.Dedup)
+    Dedup.Blocks, Dedup.Keys = dict(Dedup.Blocks), dict(Dedup.Keys)
+    Counts = (sys.BitMap.FreeAMT, sys.BitMap.NextFree, sys.BitMap.Logical)
+    return {'Counts': Counts, 'RootDir': Tree, 'Snapshots': dict(sys.Snapshots), 'Dedup': Dedup,
+            'Compress': sys.Compress, 'Size': sys.Size, 'CtDir': sys.CtDir, 'CtUser': sys.CtUser, 'Seq': seq}
+
+
+def FreezeTree(source: Dir) -> tuple:
+    """
+    复制目录树中每个目录和文件的属性字典，返回 (原目录, 目录的属性, [子目录的复制结果或文件的属性, ...])
+
+    文件的属性都不会被原地修改，复制属性字典就足够了
+    """
+    return source, source.__dict__.copy(), [FreezeTree(obj) if obj.type == b'dir' else obj.__dict__.copy()
+                                            for obj in source.son.values()]
+
+
+def ThawMeta(meta: dict) -> dict:
+    """由 FreezeMeta 复制的元数据重建目录树，不需要持有锁"""
+    Dirs = {}
+    Root = ThawTree(meta['RootDir'], None, Dirs)
+    CtDir = meta['CtDir']
+    if id(CtDir) in Dirs:
+        CtDir = Dirs[id(CtDir)]
+    elif not CtDir.path.startswith(SNAP_PREFIX):
+        # 当前目录已被删除，加载时回到根目录
+        CtDir = Root
+    return dict(meta, RootDir=Root, CtDir=CtDir)
+
+
+def ThawTree(frozen: tuple, father: (Dir | None), dirs: dict) -> Dir:
+    """由 FreezeTree 的结果重建目录树，重建的目录记录在 dirs（原目录的id -> 重建的目录）中"""
+    Source, State, Sons = frozen
+    Copy = object.__new__(Dir)
+    Copy.__dict__.update(State)
+    Copy.father, Copy.son = father, {}
+    dirs[id(Source)] = Copy
+    for Son in Sons:
+        if type(Son) is tuple:
+            Son = ThawTree(Son, Copy, dirs)
+        else:
+            Attrs, Son = Son, object.__new__(File)
+            Son.__dict__.update(Attrs)
+        Copy.son[Son.name] = Son
+    return Copy
+
+
+def WriteImage(snapshot: dict, path: str) -> None:
+    """
+    将快照写入镜像文件，先序列化元数据，元数据写完后再写超级块
+
+    完整保存时写入临时文件，写完后替换原镜像文件；否则表区写入超级块未指向的一个，只写入与该表区现有内容不同的部分，
+    新的元数据写在不与原元数据重叠的位置，超级块指向新的表区和元数据之前原来的都一直有效，保存中途中断时镜像文件仍能加载
+    """
+    Meta = pickle.dumps(ThawMeta(snapshot['Meta']))
+    Tables, Written = memoryview(snapshot['Tables']), snapshot['ImageTables']
+    Target = path + '.tmp' if snapshot['Full'] else path
+    with open(Target, 'wb' if snapshot['Full'] else 'r+b') as f:
+        if snapshot['Full']:
+            MetaOffset, Slot = META_OFFSET, 0
+        else:
+            _, _, _, _, OldOffset, OldLength, OldSlot = SUPER_BLOCK.unpack(f.read(SUPER_BLOCK.size))
+            MetaOffset = META_OFFSET if META_OFFSET + len(Meta) <= OldOffset else OldOffset + OldLength
+            Slot = 1 - OldSlot
+
+        # 块区域
+        for Start, Data in snapshot['Blocks']:
+            f.seek(BLOCK_OFFSET + (Start - BLOCK_STR) * BLOCK_SIZE)
+            f.write(Data)
+
+        # 表区，写入中途中断时该表区的内容未知
+        Old, Written[Slot] = Written[Slot], None
+        Base = TABLE_OFFSET + Slot * TABLE_SIZE
+        for Start in range(0, TABLE_SIZE, TABLE_CHUNK):
+            Chunk = Tables[Start:Start + TABLE_CHUNK]
+            if Old is None or Old[Start:Start + TABLE_CHUNK] != Chunk:
+                f.seek(Base + Start)
+                f.write(Chunk)
+
+        # 元数据区
+        f.seek(MetaOffset)
+        f.write(Meta)
+        f.flush()
+        os.fsync(f.fileno())
+
+        # 超级块
+        f.seek(0)
+        f.write(SUPER_BLOCK.pack(IMAGE_MAGIC, IMAGE_VERSION, BLOCK_SIZE, BLOCK_AMT, MetaOffset, len(Meta), Slot))
+        f.flush()
+        os.fsync(f.fileno())
+
+        # 原元数据已经失效，截去新的元数据之后的部分
+        f.truncate(MetaOffset + len(Meta))
+
+    if snapshot['Full']:
+        os.replace(Target, path)
+    Written[Slot] = snapshot['Tables']
+
+
+def ReadImage(path: str, use_mmap: bool = False) -> FileSystem:
+    """
+    从镜像文件加载文件系统，use_mmap为True时块区域私有映射到镜像文件，用到的盘块才从镜像文件读入
+
+    私有映射时其他线程的写入只修改内存中的副本，保存时与不映射时一样写入拍下快照时复制的盘块，镜像文件中的块区域总与元数据一致
+    """
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        # 版本1的超级块之后都是0，按当前的格式读出的表区序号为0
+        Magic, Version, BlockSize, BlockAmt, MetaOffset, MetaLength, Slot = SUPER_BLOCK.unpack(f.read(SUPER_BLOCK.size))
+        if Magic != IMAGE_MAGIC or Version not in (1, IMAGE_VERSION) or BlockSize != BLOCK_SIZE or BlockAmt != BLOCK_AMT:
+            raise ValueError('不是本系统的镜像文件')
+
+        if use_mmap:
+            sys = FileSystem(path, BLOCK_OFFSET, True)
+        else:
+            sys = FileSystem()
+            f.seek(BLOCK_OFFSET)
+            f.readinto(sys.Storage.View)
+
+        if Version == IMAGE_VERSION:
+            f.seek(TABLE_OFFSET)
+            sys.ImageTables = [f.read(TABLE_SIZE), f.read(TABLE_SIZE)]
+            UnpackTables(sys, sys.ImageTables[Slot])
+
+        f.seek(MetaOffset)
+        Meta = pickle.loads(f.read(MetaLength))
+
+    if Version == IMAGE_VERSION:
+        sys.BitMap.FreeAMT, sys.BitMap.NextFree, sys.BitMap.Logical = Meta['Counts']
+    else:
+        sys.BitMap, sys.FAT, sys.Storage.Length = Meta['BitMap'], Meta['FAT'], Meta['Length']
+    sys.RootDir, sys.CtDir, sys.CtUser = Meta['RootDir'], Meta['CtDir'], Meta['CtUser']
+    sys.Snapshots = Meta.get('Snapshots', {})
+    sys.Dedup = Meta.get('Dedup', sys.Dedup)
+    sys.Compress = Meta.get('Compress', False)
+    # 没有文件大小之和的旧镜像文件，遍历目录树和快照求和
+    if 'Size' in Meta:
+        sys.Size = Meta['Size']
+    else:
+        sys.Size = sum(obj.size for Root in [sys.RootDir, *sys.Snapshots.values()] for obj in AllFiles(Root))
+    sys.JournalSeq = Meta['Seq']
+    sys.MetaDirty = False
+    # 版本1的镜像文件下次保存时完整保存为当前的格式
+    sys.ImagePath = path if Version == IMAGE_VERSION else None
+    return sys
+
+
+def SysInitialization(confirm: bool = True) -> FileSystem:
+    """初始化文件系统，并重做操作日志中镜像文件之后的操作，confirm为False时没有镜像文件也不需要确认"""
+    try:
+        sys = LoadSys()
     except FileNotFoundError as e:
-        print(e.__str__(), '\n按下回车进入初始化系统')
-        input()
-        return SysInit()
+        print(e.__str__(), '\n按下回车进入初始化系统' if confirm else '\n进入初始化系统')
+        if confirm:
+            input()
+        sys = SysInit()
+
+    OpenJournal(sys)
+    return sys
+
+
+def OpenJournal(sys: FileSystem) -> None:
+    """重做操作日志中镜像文件之后的操作，然后开始记录日志并保存一次"""
+    Records = [Record for Record in ReadJournal(PATH + JOURNAL_NAME) if Record[0] > sys.JournalSeq]
+    ReplayJournal(sys, Records)
+    if Records:
+        sys.JournalSeq = Records[-1][0]
+
+    sys.Journal = Journal(PATH + JOURNAL_NAME, sys.JournalSeq)
+    SaveSys(sys)
+
+
+def ReplayJournal(sys: FileSystem, records: list) -> None:
+    """依次重做日志中的操作，不输出结果"""
+    cmd = Command(sys)
+    CtDir = sys.CtDir
+    with redirect_stdout(StringIO()):
+        for _, Op, Args in records:
+            try:
+                getattr(cmd, Op)(*Args)
+            except Exception:
+                # 当时执行出错的操作，重做时同样出错
+                pass
+    sys.CtDir = CtDir
+
+
+def interactive(input_list: list, cmd: Command, confirm: bool = True) -> bool:
+    """初步筛查输入信息并调用对应函数，confirm为False时删除目录不需要确认，开启了性能分析时进行分析"""
+    if input_list[0] != 'prof' and PROFILER.Armed():
+        return PROFILER.Run(' '.join(input_list), dispatch, input_list, cmd, confirm)
+    return dispatch(input_list, cmd, confirm)
 
 
-def interactive(input_list: list, cmd: Command) -> bool:
-    """初步筛查输入信息并调用对应函数"""
+def dispatch(input_list: list, cmd: Command, confirm: bool = True) -> bool:
+    """根据输入调用对应函数，返回是否退出"""
     # 查看帮助信息
     if input_list[0] == 'h':
         cmd.help()
@@ -98,6 +424,13 @@ def interactive(input_list: list, cmd: Command) -> bool:
             return False
         print(cmd.rm(input_list[1]))
 
+    # 复制文件/目录
+    elif input_list[0] == 'cp':
+        if len(input_list) != 3:
+            print('请输入：cp 源路径 目标路径')
+            return False
+        cmd.cp(input_list[1], input_list[2])
+
     # 查看子目录和文件信息
     elif input_list[0] == 'ls':
         if len(input_list) > 2:
@@ -117,10 +450,15 @@ def interactive(input_list: list, cmd: Command) -> bool:
 
     # 递归移除目录
     elif input_list[0] == 'rmdir':
-        if len(input_list) != 2:
+        # -f 不需要确认，-q 删除成功时不输出信息
+        Flags = [arg for arg in input_list[1:] if arg in ('-f', '-q')]
+        Paths = [arg for arg in input_list[1:] if arg not in ('-f', '-q')]
+        if len(Paths) != 1:
             print('请输入正确的目录名')
             return False
-        print(cmd.rmdir(input_list[1]))
+        Result = cmd.rmdir(Paths[0], confirm and '-f' not in Flags, '-q' in Flags)
+        if Result:
+            print(Result)
 
     # 进入 子目录/根目录
     elif input_list[0] == 'cd':
@@ -139,6 +477,20 @@ def interactive(input_list: list, cmd: Command) -> bool:
     elif input_list[0] == 'cat':
         cmd.cat(input_list[1:])
 
+    # 从指定位置读取文件内容
+    elif input_list[0] == 'read':
+        if len(input_list) != 4 or not input_list[2].isdigit() or not input_list[3].isdigit():
+            print('请输入：read 文件名 位置 长度')
+            return False
+        cmd.read(input_list[1], int(input_list[2]), int(input_list[3]))
+
+    # 从指定位置写入文件内容
+    elif input_list[0] == 'write':
+        if len(input_list) != 4 or not input_list[2].isdigit():
+            print('请输入：write 文件名 位置 内容')
+            return False
+        cmd.write(input_list[1], int(input_list[2]), input_list[3])
+
     # 查看空间使用情况
     elif input_list[0] == 'disk':
         if len(input_list) != 1:
@@ -146,6 +498,62 @@ def interactive(input_list: list, cmd: Command) -> bool:
             return False
         cmd.disk()
 
+    # 查看性能统计
+    elif input_list[0] == 'stats':
+        if len(input_list) > 2 or input_list[1:] not in ([], ['on'], ['off'], ['reset'], ['json']):
+            print('请输入：stats [on|off|reset|json]')
+            return False
+        cmd.stats(*input_list[1:])
+
+    # 分析命令的性能
+    elif input_list[0] == 'prof':
+        op, args = input_list[1] if len(input_list) > 1 else None, input_list[2:]
+        if op in (None, 'off', 'reset') and not args:
+            cmd.prof(op)
+        elif op == 'next' and len(args) <= 1 and all(arg.isdigit() for arg in args):
+            cmd.prof(op, int(args[0]) if args else 1)
+        elif op == 'slow' and len(args) == 1 and args[0].replace('.', '', 1).isdigit():
+            cmd.prof(op, float(args[0]))
+        elif op == 'dump' and len(args) <= 1:
+            cmd.prof(op, args[0] if args else os.path.abspath(PATH + PROFILE_NAME))
+        else:
+            print('请输入：prof [next 命令数|slow 毫秒|off|reset|dump 文件名]')
+            return False
+
+    # 查看碎片情况/整理碎片
+    elif input_list[0] == 'defrag':
+        if len(input_list) == 1:
+            cmd.defrag()
+        elif input_list[1] == 'run' and len(input_list) <= 3 and all(arg.isdigit() for arg in input_list[2:]):
+            cmd.defrag('run', *[int(arg) for arg in input_list[2:]])
+        else:
+            print('请输入：defrag [run [时间片毫秒数]]')
+            return False
+
+    # 去重
+    elif input_list[0] == 'dedup':
+        if input_list[1:] not in ([], ['on'], ['off']):
+            print('请输入：dedup [on/off]')
+            return False
+        cmd.dedup(*input_list[1:])
+
+    # 压缩
+    elif input_list[0] == 'compress':
+        if len(input_list) > 3 or input_list[1:2] not in ([], ['on'], ['off']):
+            print('请输入：compress [on/off [文件名]]')
+            return False
+        cmd.compress(*input_list[1:])
+
+    # 快照
+    elif input_list[0] == 'snap':
+        if len(input_list) == 1 or input_list[1:] == ['list']:
+            cmd.snap()
+        elif len(input_list) == 3 and input_list[1] in ('create', 'mount', 'rollback', 'delete'):
+            cmd.snap(input_list[1], input_list[2])
+        else:
+            print('请输入：snap [list | create/mount/rollback/delete 快照名]')
+            return False
+
     # 退出
     elif input_list[0] == 'exit':
         return True
@@ -187,10 +595,106 @@ def main():
             break
 
 
-if __name__ == '__main__':
+def ParseScript(lines, cmd: Command) -> list:
+    """
+    解析命令脚本，返回 (行号, 命令参数列表) 的列表
+
+    跳过空行和以 '#' 开头的注释，遇到 exit 时停止，有无法识别的命令时报错
+    """
+    Commands = []
+    Errors = []
+    for LineNum, Line in enumerate(lines, 1):
+        InputList = Line.split()
+        if len(InputList) == 0 or InputList[0].startswith('#'):
+            continue
+        if InputList[0] not in cmd.command.keys():
+            Errors.append(f'第{LineNum}行：没有找到命令 {InputList[0]}')
+            continue
+        Commands.append((LineNum, InputList))
+        if InputList[0] == 'exit':
+            break
+
+    if Errors:
+        raise ValueError('\n'.join(Errors))
+    return Commands
+
+
+def Batch(script: str) -> None:
+    """
+    批量执行命令脚本，script为 '-' 时从标准输入读取
+
+    先解析整个脚本再依次执行，不输出提示符、不清屏，删除目录不需要确认；
+    执行期间照常记录操作日志但不逐条等待写入磁盘，每隔BATCH_SAVE_INTERVAL秒保存一次，
+    输出先写入缓冲区再批量写出，结束后保存一次，并输出每种命令的用时统计
+    """
+    sys_lch = SysInitialization(False)
+    cmd = Command(sys_lch)
+    if script == '-':
+        Lines = _sys.stdin.read().splitlines()
+    else:
+        with open(script, encoding='utf-8') as f:
+            Lines = f.read().splitlines()
+    try:
+        Commands = ParseScript(Lines, cmd)
+    except ValueError as e:
+        print(e.__str__(), file=_sys.stderr)
+        return
+
+    # 日志由后台线程成组写入，中途崩溃时下次启动重做已写入磁盘的命令，只丢失最后一组还未写入的；
+    # 定期保存并删除已保存的日志，日志不会随脚本无限增长
+    sys_lch.Journal.Deferred = True
+
+    Stats = {}  # 命令 -> [执行次数, 总用时]
+    Output = StringIO()
+    Start = LastSave = perf_counter()
     try:
-        main()
-        system("cls")  # 退出系统时清屏
-    except EOFError:
-        print('\nKeyBoardInterrupt')
-        QUIT()
+        for LineNum, InputList in Commands:
+            if QUIT_FLAG:
+                break
+            CmdStart = perf_counter()
+            if CmdStart - LastSave >= BATCH_SAVE_INTERVAL:
+                SaveSys(sys_lch)
+                LastSave = CmdStart = perf_counter()
+            with redirect_stdout(Output):
+                try:
+                    Exit = interactive(InputList, cmd, False)
+                except Exception as e:
+                    print(f'第{LineNum}行：' + e.__str__())
+                    Exit = False
+            Stat = Stats.setdefault(InputList[0], [0, 0.0])
+            Stat[0] += 1
+            Stat[1] += perf_counter() - CmdStart
+
+            if Output.tell() >= BATCH_OUTPUT_SIZE:
+                _sys.stdout.write(Output.getvalue())
+                Output.seek(0)
+                Output.truncate()
+            if Exit:
+                break
+    finally:
+        _sys.stdout.write(Output.getvalue())
+        _sys.stdout.flush()
+        Total = perf_counter() - Start
+        SaveSys(sys_lch)
+        sys_lch.Journal.Close()
+
+    print(f'{"命令":<8}{"次数":>10}{"总用时(s)":>14}{"平均(us)":>12}', file=_sys.stderr)
+    for Name, (Count, Time) in Stats.items():
+        print(f'{Name:<10}{Count:>12}{Time:>16.4f}{Time / Count * 1e6:>14.1f}', file=_sys.stderr)
+    print(f'共执行{sum(Stat[0] for Stat in Stats.values())}条命令，用时{Total:.4f}s', file=_sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='文件系统')
+    parser.add_argument('script', nargs='?', help='批量执行的命令脚本，- 表示从标准输入读取')
+    args = parser.parse_args()
+
+    if args.script is not None:
+        Batch(args.script)
+    else:
+        try:
+            main()
+            system("cls")  # 退出系统时清屏
+        except EOFError:
+            print('\nKeyBoardInterrupt')
+            QUIT()
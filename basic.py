@@ -2,6 +2,16 @@ from __future__ import annotations
 import time
 import math
 import threading
+import re
+import mmap
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import blake2b
+import zlib
+import metrics
+from metrics import timed
 
 # 64 * 1024个块，一个块大小为256B，总共16MB
 BLOCK_AMT = 64 * 1024 - 2
@@ -14,102 +24,478 @@ BLOCK_SIZE = 256
 # 舍去了 第一块(0x0000），最后一块(0xFFFF)
 BLOCK_STR = 1
 BLOCK_END = 0xFFFE
-FAT_END_FLAG = 'FFFF'
-FAT_ENTRY_SIZE = 4
+FAT_FREE_FLAG = 0x0000
+FAT_END_FLAG = 0xFFFF
+FAT_ENTRY_SIZE = 2
+
+# 位示图中未被占满的字节（存在空闲盘块）
+NOT_FULL_BYTE = re.compile(rb'[^\xff]')
+
+# 压缩文件按帧压缩，每帧为16个盘块大小的原始数据，压缩后占用整数个盘块
+FRAME_SIZE = 16 * BLOCK_SIZE
+
+# 不超过此大小的文件内嵌在文件记录中，不占用盘块
+INLINE_SIZE = BLOCK_SIZE // 2
+
+# 路径解析缓存最多记录的路径数
+PATH_CACHE_SIZE = 4096
 
 HELP_MSG = f"这是 操作系统课程设计实验课 试验11 的 模拟文件系统\n" \
            f"使用位示图管理内存空间，FAT表记录文件映射\n" \
            f"每一个块大小为{BLOCK_SIZE}B，有{BLOCK_AMT}个块，总共{round((BLOCK_SIZE * BLOCK_AMT) / (1024 * 1024), 2)}M大小"
 
-# 写锁
-# 请求 .acquire()
-# 释放 .release()
-WriteLock = threading.Lock()
+# 锁的层次，按从外到内的顺序请求：
+# 卷锁      VolumeLock      修改目录树、保存镜像文件时持有写锁，读写文件内容时持有读锁
+# 文件锁    File.Lock       读文件时持有读锁，修改文件时持有写锁，不同文件的读写可以同时进行
+# 分配锁    AllocLock       分配、释放盘块（位示图、FAT表）期间持有
 
 
-class FAT:
+class RWLock:
     """
-    创建FAT表，包括方法:
-        AddEntry -> 增加表项\n
-        AddEndFlag -> 增加文件结束标志\n
-        ReadEntry -> 从指定位置读取表项\n
-        DelEntry -> 从指定位置删除表项
+    读写锁，读锁可以同时被多个线程持有，写锁只能被一个线程持有，
+    有线程在等待写锁时不再授予新的读锁，避免写锁饿死，包括方法：
+        AcquireRead -> 请求读锁\n
+        ReleaseRead -> 释放读锁\n
+        AcquireWrite -> 请求写锁\n
+        ReleaseWrite -> 释放写锁\n
+        Read -> 在with语句中持有读锁\n
+        Write -> 在with语句中持有写锁
     """
 
     def __init__(self):
-        self.FAT = FAT_END_FLAG
+        self.Cond = threading.Condition(threading.Lock())
+        self.Readers = 0  # 持有读锁的线程数
+        self.Writer = False  # 是否有线程持有写锁
+        self.WaitingWriters = 0  # 等待写锁的线程数
+
+    def AcquireRead(self) -> None:
+        """请求读锁，需要等待且开启了统计时记录等待时间"""
+        with self.Cond:
+            if self.Writer or self.WaitingWriters > 0:
+                Start = time.perf_counter()
+                while self.Writer or self.WaitingWriters > 0:
+                    self.Cond.wait()
+                if metrics.ENABLED:
+                    metrics.Observe('lock.read_wait', time.perf_counter() - Start)
+            self.Readers += 1
+
+    def ReleaseRead(self) -> None:
+        """释放读锁"""
+        with self.Cond:
+            self.Readers -= 1
+            if self.Readers == 0:
+                self.Cond.notify_all()
+
+    def AcquireWrite(self) -> None:
+        """请求写锁，需要等待且开启了统计时记录等待时间"""
+        with self.Cond:
+            if self.Writer or self.Readers > 0:
+                Start = time.perf_counter()
+                self.WaitingWriters += 1
+                while self.Writer or self.Readers > 0:
+                    self.Cond.wait()
+                self.WaitingWriters -= 1
+                if metrics.ENABLED:
+                    metrics.Observe('lock.write_wait', time.perf_counter() - Start)
+            self.Writer = True
+
+    def ReleaseWrite(self) -> None:
+        """释放写锁"""
+        with self.Cond:
+            self.Writer = False
+            self.Cond.notify_all()
+
+    @contextmanager
+    def Read(self):
+        """在with语句中持有读锁"""
+        self.AcquireRead()
+        try:
+            yield
+        finally:
+            self.ReleaseRead()
+
+    @contextmanager
+    def Write(self):
+        """在with语句中持有写锁"""
+        self.AcquireWrite()
+        try:
+            yield
+        finally:
+            self.ReleaseWrite()
+
+
+VolumeLock = RWLock()
+AllocLock = threading.Lock()
+Resizing = threading.local()  # 当前线程是否正在执行会改变文件大小的方法
+
+
+def resized(func):
+    """
+    将此装饰器应用到会改变文件大小的FileSystem方法（第一个参数为文件）上，执行后将文件大小的变化计入文件大小之和\n
+    嵌套调用时只在最外层计入，内部写入的临时文件不会被计入
+    """
+    @wraps(func)  # 复制原函数元信息
+    def wrapper(self, file, *args):
+        if getattr(Resizing, 'Active', False):
+            return func(self, file, *args)
 
-    def AddEntry(self, s: str) -> None:
-        """在表的末尾添加表项"""
-        self.FAT += FillStr(s, 4, '0', 0)
+        Before = file.size
+        Resizing.Active = True
+        try:
+            return func(self, file, *args)
+        finally:
+            Resizing.Active = False
+            with AllocLock:
+                self.Size += file.size - Before
 
-    def AddEndFlag(self) -> None:
-        """在表的末尾添加结束标志"""
-        self.FAT += FAT_END_FLAG
+    return wrapper
 
-    def ReadEntry(self, place: int) -> str:
-        """读取指定位置表项"""
-        return self.FAT[place: place + FAT_ENTRY_SIZE]
 
-    def DelEntry(self, place: int) -> None:
-        """删除指定位置表项"""
-        self.FAT = self.FAT[: place] + self.FAT[place + 4:]
+class FAT:
+    """
+    创建FAT表，以盘块号为下标，表项为该盘块的下一盘块号，包括方法:
+        SetEntry -> 设置指定盘块的表项\n
+        ReadEntry -> 读取指定盘块的表项\n
+        DelEntry -> 清空指定盘块的表项\n
+        Chain -> 从首盘块开始依次返回文件占用的盘块号
+    """
+
+    def __init__(self):
+        # 每个表项16位，下标 0 ~ BLOCK_END，第0项不使用
+        self.FAT = array('H', bytes(FAT_ENTRY_SIZE * (BLOCK_END + 1)))
+
+    def SetEntry(self, block_num: int, next_block: int = FAT_END_FLAG) -> None:
+        """设置指定盘块的下一盘块号，默认设为文件结束符"""
+        self.FAT[block_num] = next_block
+
+    def ReadEntry(self, block_num: int) -> int:
+        """读取指定盘块的下一盘块号"""
+        return self.FAT[block_num]
+
+    def DelEntry(self, block_num: int) -> None:
+        """清空指定盘块的表项"""
+        self.FAT[block_num] = FAT_FREE_FLAG
+
+    def Chain(self, first_block: int):
+        """从首盘块开始沿FAT表依次返回盘块号，直到读到结束符"""
+        BlockNum = first_block
+        Links = 0
+        try:
+            while BlockNum != FAT_END_FLAG:
+                yield BlockNum
+                BlockNum = self.FAT[BlockNum]
+                Links += 1
+        finally:
+            if metrics.ENABLED:
+                metrics.Count('fat.links', Links)
 
 
 class BitMap:
     """
-    创建位示图，包括方法：
+    创建位示图（每个盘块占1位），包括方法：
         GetEmptyBlock -> 获得一个盘块为空的盘块号\n
+        Allocate -> 一次获得多个为空的盘块号并置1，优先分配连续的盘块\n
+        FindEmptyRun -> 找到一段足够长的连续空闲盘块\n
+        SetRun -> 将一段连续盘块的位示图置1\n
+        FreeRuns -> 所有连续空闲盘块的区间\n
         EmptyBlockAMT -> 获得所有为空的盘块数\n
         Write -> 写入指定盘块位示图\n
         Read -> 读取指定盘块位示图\n
+        Share -> 增加盘块的引用计数\n
+        Release -> 减少盘块的引用计数，减为0时释放盘块\n
+
+    已分配的盘块记录引用计数（共用此盘块的文件数），复制的文件与原文件共用盘块\n
+    同时维护引用计数之和，即所有文件的逻辑占用盘块数
     """
 
     def __init__(self):
-        self.BitMap = {i: 0 for i in range(BLOCK_STR, BLOCK_END + 1)}
+        # 下标 0 ~ 0xFFFF，舍去的第一块和最后一块始终置1
+        self.BitMap = bytearray((FAT_END_FLAG + 1) // 8)
+        self.BitMap[BLOCK_STR - 1 >> 3] |= 1 << (BLOCK_STR - 1 & 7)
+        self.BitMap[BLOCK_END + 1 >> 3] |= 1 << (BLOCK_END + 1 & 7)
+        self.FreeAMT = BLOCK_END - BLOCK_STR + 1  # 空闲盘块数
+        self.NextFree = BLOCK_STR  # 下一次开始查找空闲盘块的位置
+        # 每个盘块的引用计数，0表示空闲；复制和快照可以让一个盘块被很多文件共用，每项32位
+        self.Refs = array('I', bytes(4 * (FAT_END_FLAG + 1)))
+        self.Logical = 0  # 引用计数之和，共用的盘块按共用的文件数重复计算
 
     def GetEmptyBlock(self) -> int:
         """
         每次找到一个空闲的块，并返回块号\n
         若没有空闲的块则返回 -1
         """
-        if 0 not in self.BitMap.values():
+        if self.FreeAMT == 0:
             return -1
 
-        for i in range(BLOCK_STR, BLOCK_END + 1):
-            if self.BitMap[i] == 0:
-                return i
+        return next(self.FindEmptyBlocks())
+
+    @timed('bitmap.allocate')
+    def Allocate(self, amount: int, hint: int = None) -> list:
+        """
+        一次找到amount个空闲的块，将位示图置1并返回块号列表\n
+        优先分配从hint开始的盘块（用于接在文件末尾），其次是一段足够长的连续空闲块，
+        都找不到时再从上次分配的位置开始逐个分配\n
+        若空闲的块不足则返回空列表
+        """
+        if amount > self.FreeAMT:
+            return []
+
+        if hint is not None and hint + amount - 1 <= BLOCK_END \
+                and not any(self.Read(BlockNum) for BlockNum in range(hint, hint + amount)):
+            Start = hint
+        else:
+            Start = self.FindEmptyRun(amount)
+
+        if Start is not None:
+            Blocks = list(range(Start, Start + amount))
+            self.SetRun(Start, amount)
+            self.Refs[Start: Start + amount] = array('I', [1]) * amount
+        else:
+            Blocks = []
+            for BlockNum in self.FindEmptyBlocks():
+                if len(Blocks) == amount:
+                    break
+                self.BitMap[BlockNum >> 3] |= 1 << (BlockNum & 7)
+                self.Refs[BlockNum] = 1
+                Blocks.append(BlockNum)
+
+        self.FreeAMT -= amount
+        self.Logical += amount
+        if metrics.ENABLED:
+            metrics.Count('blocks.allocated', amount)
+        if Blocks:
+            self.NextFree = Blocks[-1] + 1 if Blocks[-1] < BLOCK_END else BLOCK_STR
+        return Blocks
+
+    def FindEmptyRun(self, amount: int, start: int = None) -> (int | None):
+        """
+        从start（默认为上次分配的位置）开始循环查找连续ceil(amount / 8)个全空的字节，返回其中第一个块号\n
+        找不到时返回None
+        """
+        if amount == 0:
+            return None
+
+        Need = -(-amount // 8)
+        Pattern = re.compile(rb'\x00{%d}' % Need)
+        Start = (self.NextFree if start is None else start) >> 3
+        for ByteStr, ByteEnd in ((Start, len(self.BitMap)), (0, min(len(self.BitMap), Start + Need))):
+            Match = Pattern.search(self.BitMap, ByteStr, ByteEnd)
+            if Match is not None:
+                return Match.start() << 3
+        return None
+
+    def SetRun(self, start: int, amount: int) -> None:
+        """将从start开始的amount个块的位示图置1，中间的整字节直接填满"""
+        End = start + amount
+        ByteStr, ByteEnd = -(-start // 8), End >> 3
+        if ByteStr >= ByteEnd:
+            Bits = range(start, End)
+        else:
+            self.BitMap[ByteStr: ByteEnd] = b'\xff' * (ByteEnd - ByteStr)
+            Bits = list(range(start, ByteStr << 3)) + list(range(ByteEnd << 3, End))
+        for BlockNum in Bits:
+            self.BitMap[BlockNum >> 3] |= 1 << (BlockNum & 7)
+
+    def FreeRuns(self) -> list:
+        """返回所有连续空闲盘块的区间 (起始盘块号, 盘块数)，按盘块号排列"""
+        # 第i位对应第i个盘块
+        Bits = format(int.from_bytes(self.BitMap, 'little'), '0%db' % (len(self.BitMap) * 8))[::-1]
+        return [(Match.start(), Match.end() - Match.start()) for Match in re.finditer('0+', Bits)]
+
+    def FindEmptyBlocks(self):
+        """从上次分配的位置开始循环查找，依次返回空闲的块号"""
+        Start = self.NextFree >> 3
+        for ByteStr, ByteEnd in ((Start, len(self.BitMap)), (0, Start + 1)):
+            for Match in NOT_FULL_BYTE.finditer(self.BitMap, ByteStr, ByteEnd):
+                Byte = self.BitMap[Match.start()]
+                for Bit in range(8):
+                    if not Byte >> Bit & 1:
+                        yield Match.start() << 3 | Bit
 
     def EmptyBlockAMT(self) -> int:
         """返回空闲盘块的数量"""
-        return list(self.BitMap.values()).count(0)
+        return self.FreeAMT
 
     def Write(self, block_num: int, bit: int = 0 or 1) -> None:
-        """写入指定盘块位示图"""
-        self.BitMap[block_num] = bit
+        """写入指定盘块位示图，引用计数随之置为1或0"""
+        self.Logical += bit - self.Refs[block_num]
+        self.Refs[block_num] = bit
+        if self.Read(block_num) == bit:
+            return
+
+        self.BitMap[block_num >> 3] ^= 1 << (block_num & 7)
+        self.FreeAMT += -1 if bit else 1
 
     def Read(self, block_num: int) -> int:
         """读取指定盘块位示图"""
-        return self.BitMap[block_num]
+        return self.BitMap[block_num >> 3] >> (block_num & 7) & 1
+
+    def Share(self, blocks: list) -> None:
+        """盘块多了一个文件共用，引用计数加1"""
+        for BlockNum in blocks:
+            self.Refs[BlockNum] += 1
+        self.Logical += len(blocks)
+
+    def Release(self, block_num: int) -> bool:
+        """盘块少了一个文件使用，引用计数减1，减为0时释放盘块并返回True"""
+        self.Refs[block_num] -= 1
+        self.Logical -= 1
+        if self.Refs[block_num] > 0:
+            return False
+        self.Write(block_num, 0)
+        return True
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        # 没有引用计数的旧镜像文件，已分配的盘块引用计数均为1
+        if 'Refs' not in state:
+            self.Refs = array('I', bytes(4 * (FAT_END_FLAG + 1)))
+            for BlockNum in range(BLOCK_STR, BLOCK_END + 1):
+                self.Refs[BlockNum] = self.Read(BlockNum)
+        # 引用计数为16位的旧镜像文件
+        elif self.Refs.typecode != 'I':
+            self.Refs = array('I', self.Refs)
+        # 没有逻辑占用计数的旧镜像文件，由引用计数求和得到
+        if 'Logical' not in state:
+            self.Logical = sum(self.Refs[BLOCK_STR: BLOCK_END + 1])
+
+
+class DedupIndex:
+    """
+    去重索引，记录 (盘块内容的摘要, 下一盘块号) 到 盘块号 的映射，包括方法：
+        Digest -> 计算盘块内容的摘要\n
+        Find -> 查找内容和后继都相同的盘块\n
+        Add -> 记录盘块\n
+        Forget -> 删除盘块的记录，盘块被修改或释放前调用
+
+    FAT表中每个盘块只有一个后继，所以只有内容和后继都相同的盘块才能共用，
+    从文件末尾向前查找，可以共用的部分总是文件的一段后缀；需要持有分配锁
+    """
+
+    def __init__(self):
+        self.Enabled = False  # 写入时是否去重
+        self.Blocks = {}  # (摘要, 下一盘块号) -> 盘块号
+        self.Keys = {}  # 盘块号 -> (摘要, 下一盘块号)
+
+    @staticmethod
+    def Digest(data: bytes) -> bytes:
+        """盘块内容的摘要"""
+        return blake2b(data, digest_size=16).digest()
+
+    def Find(self, digest: bytes, next_block: int) -> (int | None):
+        """查找内容摘要为digest、下一盘块为next_block的盘块，没有时返回None"""
+        return self.Blocks.get((digest, next_block))
+
+    def Add(self, block_num: int, digest: bytes, next_block: int) -> None:
+        self.Blocks[(digest, next_block)] = block_num
+        self.Keys[block_num] = (digest, next_block)
+
+    def Forget(self, block_num: int) -> None:
+        Key = self.Keys.pop(block_num, None)
+        if Key is not None:
+            del self.Blocks[Key]
 
 
 class Storage:
     """
-    虚拟存储空间的创建，包括方法：
+    虚拟存储空间的创建，所有盘块存放在一整块连续的缓冲区中，
+    可选择映射(mmap)到本地文件，私有映射时写入只修改内存中的副本，不会写回本地文件，包括方法：
         Write -> 将指定数据写入指定盘块号中\n
-        Read -> 读取指定盘块号数据\n
+        WriteRun -> 将数据依次写入一段连续的盘块中\n
+        Read -> 读取指定盘块号数据（不复制，返回memoryview）\n
+        ReadRun -> 读取一段连续盘块中的数据（不复制，返回memoryview）\n
+        ReadRaw -> 读取连续的若干个完整盘块（不复制，返回memoryview）\n
+        Flush -> 将映射的缓冲区写回本地文件\n
+        Close -> 关闭映射的本地文件
     """
 
-    def __init__(self):
-        self.Storage = {i: b'' for i in range(BLOCK_STR, BLOCK_END + 1)}
+    def __init__(self, path: str = None, offset: int = 0, private: bool = False):
+        self.path = path  # 映射的本地文件，None表示只存放在内存中
+        self.offset = offset  # 映射的区域在本地文件中的起始位置，需为mmap分配粒度的整数倍
+        self.private = private  # 是否为私有映射（写时复制）
+        self.Length = array('H', bytes(2 * (BLOCK_END + 1)))  # 每个盘块中数据的长度
+        self.Dirty = set()  # 上次保存之后写入过的盘块号
+        self.Open()
+
+    def Open(self) -> None:
+        """创建缓冲区，若指定了本地文件则映射到该文件"""
+        if self.path is None:
+            self.Storage = bytearray(BLOCK_AMT * BLOCK_SIZE)
+        else:
+            with open(self.path, 'ab+') as f:
+                if f.tell() < self.offset + BLOCK_AMT * BLOCK_SIZE:
+                    f.truncate(self.offset + BLOCK_AMT * BLOCK_SIZE)
+                self.Storage = mmap.mmap(f.fileno(), BLOCK_AMT * BLOCK_SIZE, offset=self.offset,
+                                         access=mmap.ACCESS_COPY if self.private else mmap.ACCESS_WRITE)
+        self.View = memoryview(self.Storage)
+
+    def Write(self, block_num: int, data: bytes, offset: int = 0, truncate: bool = True) -> None:
+        """
+        将数据写入指定盘块号中从offset开始的位置\n
+        truncate为True时盘块中的数据截止到写入的末尾，否则保留写入末尾之后的原有数据
+        """
+        Offset = (block_num - BLOCK_STR) * BLOCK_SIZE + offset
+        self.View[Offset: Offset + len(data)] = data
+        if truncate or offset + len(data) > self.Length[block_num]:
+            self.Length[block_num] = offset + len(data)
+        self.Dirty.add(block_num)
+
+    def WriteRun(self, block_num: int, data: bytes) -> None:
+        """将数据写入从block_num开始的连续盘块中，写满一个盘块再写下一个，一次复制完成"""
+        Amount = -(-len(data) // BLOCK_SIZE)
+        Offset = (block_num - BLOCK_STR) * BLOCK_SIZE
+        self.View[Offset: Offset + len(data)] = data
+        if Amount == 0:
+            return
+        self.Length[block_num: block_num + Amount] = array('H', [BLOCK_SIZE]) * Amount
+        self.Length[block_num + Amount - 1] = len(data) - (Amount - 1) * BLOCK_SIZE
+        self.Dirty.update(range(block_num, block_num + Amount))
 
-    def Write(self, block_num: int, data: bytes) -> None:
-        """将数据写入指定盘块号中"""
-        self.Storage[block_num] = data
+    def ReadRun(self, block_num: int, amount: int) -> memoryview:
+        """读取从block_num开始的amount个连续盘块中的数据，除最后一个盘块外都需要是满的"""
+        Offset = (block_num - BLOCK_STR) * BLOCK_SIZE
+        return self.View[Offset: Offset + (amount - 1) * BLOCK_SIZE + self.Length[block_num + amount - 1]]
 
-    def Read(self, block_num: int) -> bytes:
+    def Read(self, block_num: int) -> memoryview:
         """读取指定盘块号数据"""
-        return self.Storage[block_num]
+        Offset = (block_num - BLOCK_STR) * BLOCK_SIZE
+        return self.View[Offset: Offset + self.Length[block_num]]
+
+    def ReadRaw(self, block_num: int, amount: int = 1) -> memoryview:
+        """读取从指定盘块号开始的amount个完整盘块，包括盘块中未使用的部分"""
+        Offset = (block_num - BLOCK_STR) * BLOCK_SIZE
+        return self.View[Offset: Offset + amount * BLOCK_SIZE]
+
+    def Flush(self) -> None:
+        """将映射的缓冲区写回本地文件"""
+        if self.path is not None:
+            self.Storage.flush()
+
+    def Close(self) -> None:
+        """关闭映射的本地文件"""
+        self.Flush()
+        self.View.release()
+        if self.path is not None:
+            self.Storage.close()
+
+    def __getstate__(self) -> dict:
+        """保存时，映射到本地文件的缓冲区只记录文件路径"""
+        if self.path is None:
+            return {'path': None, 'Length': self.Length, 'Storage': self.Storage}
+        self.Flush()
+        return {'path': self.path, 'offset': self.offset, 'private': self.private, 'Length': self.Length}
+
+    def __setstate__(self, state: dict) -> None:
+        self.path = state['path']
+        self.offset = state.get('offset', 0)
+        self.private = state.get('private', False)
+        self.Length = state['Length']
+        self.Dirty = set()
+        if self.path is None:
+            self.Storage = state['Storage']
+            self.View = memoryview(self.Storage)
+        else:
+            self.Open()
 
 
 class Dir:
@@ -120,7 +506,7 @@ class Dir:
         name(bytes) -> 目录名\n
         father(Dir) -> 父目录\n
         path(byte) -> 目录路径\n
-        son(Dir) -> 子目录/文件\n
+        son(dict) -> 子目录/文件名 到 子目录/文件 的映射，按添加的先后排列\n
         CreateTime(byte) -> 创建文件的时间\n
         type(bytes) -> 类型\n
 
@@ -133,26 +519,25 @@ class Dir:
     def __init__(self, dirname: bytes, path: bytes, father: Dir = None):
         self.name = dirname
         self.father = father
-        self.son = []
+        self.son = {}
         self.path = path
         self.CreateTime = GetCurrentTime()
         self.type = b'dir'
 
     def AddSon(self, other: (Dir | File)) -> None:
         """增加此目录下文件或目录"""
-        self.son.append(other)
+        self.son[other.name] = other
 
     def DelSon(self, obj: (Dir | File)) -> None:
         """此目录下文件或目录的映射关系"""
-        self.son.remove(obj)
+        del self.son[obj.name]
 
     def FindSon(self, name_bin: bytes) -> (File | Dir):
         """找到此目录中是否有某个名字的子目录/子文件"""
-        for elm in self.son:
-            if elm.name == name_bin:
-                return elm
-
-        raise Exception('没有那个文件或目录')
+        try:
+            return self.son[name_bin]
+        except KeyError:
+            raise Exception('没有那个文件或目录')
 
 
 class File:
@@ -166,6 +551,11 @@ class File:
         path(byte) -> 文件路径\n
         LastTime(str) -> 最后修改时间\n
         address(str) -> 内存储存首盘块号\n
+        Blocks(list) -> 内存储存的盘块号列表，None表示未知\n
+        Extents(list) -> 盘块号列表中的连续区段 (起始盘块号, 盘块数)，None表示未知\n
+        Frames(list) -> 压缩文件每一帧的 (盘块数, 是否压缩)，None表示文件不压缩\n
+        Inline(bytes) -> 内嵌在文件记录中的内容，None表示文件存放在盘块中\n
+        Lock(RWLock) -> 文件锁\n
         type(byte) -> 文件类型
     方法：
         Write -> 写入\n
@@ -176,15 +566,23 @@ class File:
     def __init__(self, filename: bytes, path: bytes):
         self.name = filename
         self.address = None
+        self.Blocks = None
+        self.Extents = None
+        self.Frames = None
+        self.Inline = None
         self.LastTime = GetCurrentTime()
         self.path = path
         self.power = 3
         self.size = 0
         self.type = Encode('file')
+        self.Lock = RWLock()
 
     def Write(self, address: int, size: int):
         """记录写入首盘块地址、写入时间"""
         self.address = FillStr(IntToHexStr(address), 4, '0', 0)
+        self.Blocks = None
+        self.Extents = None
+        self.Inline = None
         self.LastTime = GetCurrentTime()
         self.size = size
 
@@ -197,6 +595,67 @@ class File:
 
         self.power = power
 
+    def __getstate__(self) -> dict:
+        """保存时不保存文件锁、盘块号列表和区段"""
+        State = self.__dict__.copy()
+        del State['Lock']
+        State['Blocks'] = None
+        State['Extents'] = None
+        return State
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.Extents = None
+        self.Frames = state.get('Frames')
+        self.Inline = state.get('Inline')
+        self.Lock = RWLock()
+
+
+class PathCache:
+    """
+    路径解析缓存（LRU），记录 绝对路径 到 (父目录, 目标) 的映射，包括方法：
+        Get -> 查找路径的解析结果\n
+        Put -> 记录路径的解析结果\n
+        Invalidate -> 删除路径的解析结果\n
+        InvalidateTree -> 删除目录树中所有路径的解析结果
+    """
+
+    def __init__(self, size: int = PATH_CACHE_SIZE):
+        self.size = size
+        self.Cache = OrderedDict()
+        self.Lock = threading.Lock()  # 持有卷读锁的多个线程会同时查找和记录
+
+    def Get(self, path: bytes) -> (tuple | None):
+        """查找路径的解析结果，没有记录则返回None"""
+        with self.Lock:
+            Entry = self.Cache.get(path)
+            if Entry is not None:
+                self.Cache.move_to_end(path)
+            return Entry
+
+    def Put(self, path: bytes, entry: tuple) -> None:
+        """记录路径的解析结果，超出容量时淘汰最久未使用的记录"""
+        with self.Lock:
+            self.Cache[path] = entry
+            self.Cache.move_to_end(path)
+            if len(self.Cache) > self.size:
+                self.Cache.popitem(last=False)
+
+    def Invalidate(self, path: bytes) -> None:
+        """
+        删除路径的解析结果\n
+        只有空目录和文件能被删除，其下的路径在此之前都已删除，所以只需删除这一条记录
+        """
+        with self.Lock:
+            self.Cache.pop(path, None)
+
+    def InvalidateTree(self, path: bytes) -> None:
+        """删除路径本身以及其下所有路径的解析结果，用于一次删除整棵目录树"""
+        Prefix = path + b'/'
+        with self.Lock:
+            for Key in [Key for Key in self.Cache if Key == path or Key.startswith(Prefix)]:
+                del self.Cache[Key]
+
 
 class User:
     """用户，暂未开发"""
@@ -214,24 +673,89 @@ class FileSystem:
         Storage（Storage） -> 存储空间\n
         FAT（FAT） -> FAT表\n
         RootDir(Dir) -> 根目录\n
-        CtDir(Dir) -> 当前目录\n
+        Snapshots(dict) -> 快照名 到 快照目录树根目录 的映射，快照与目录树共用盘块\n
+        Dedup(DedupIndex) -> 去重索引，开启去重时写入的盘块与内容相同的已有盘块共用\n
+        Compress(bool) -> 新建的文件是否压缩\n
+        Size(int) -> 所有文件（包括快照中的文件）的大小之和\n
+        CtDir(Dir) -> 当前目录，在会话中为该会话的当前目录\n
+        Session(threading.local) -> 当前线程正在执行的会话，CtDir属性表示会话的当前目录\n
+        PathCache(PathCache) -> 路径解析缓存\n
+        ImagePath(str) -> 已同步的镜像文件，None表示还未保存过\n
+        ImageTables(list) -> 镜像文件两个表区中现有的内容，None表示未知\n
+        MetaDirty(bool) -> 上次保存之后目录树是否被修改过\n
+        Journal(Journal) -> 操作日志，None表示不记录\n
+        JournalSeq(int) -> 镜像文件中已包含的最后一条操作日志的序号\n
         CtUsr(User) -> 暂未开发\n
     方法：
         Write -> 写入指定数据\n
+        WriteBlocks -> 分配盘块写入数据并连成FAT链\n
+        WriteDedup -> 写入数据，与内容相同的已有盘块共用\n
+        WriteFile -> 覆盖文件内容\n
+        WriteInline -> 从内嵌文件的指定位置写入数据\n
+        Append -> 在文件末尾追加数据\n
+        ReadAt -> 从文件的指定位置读取数据\n
+        WriteAt -> 从文件的指定位置写入数据\n
+        FindBlocks -> 找到文件占用的盘块号列表\n
+        FindExtents -> 找到文件占用的连续区段\n
+        ReadExtents -> 按连续区段逐段读取文件内容\n
+        ReadFile -> 逐段读取文件内容，压缩文件逐帧解压\n
+        ReadFrames -> 读取压缩文件的若干帧并解压\n
+        WriteFrames -> 从压缩文件的指定位置写入数据\n
+        Splice -> 将文件的一段盘块替换为新的盘块\n
+        Share -> 让另一个文件共用此文件的盘块\n
+        Unshare -> 修改文件前复制与其他文件共用的盘块\n
+        Exclusive -> 统计只被指定文件使用的盘块数\n
+        Relocate -> 将文件移动到一段连续的盘块中\n
+        Fragmentation -> 统计文件和空闲空间的碎片情况\n
         Read -> 根据FAT表读取盘块中内容\n
+        ReadStream -> 根据FAT表逐块读取盘块中内容\n
+        ReadInto -> 根据FAT表将盘块中内容读入指定缓冲区\n
         Delete -> 根据输入的盘块号删除存储空间中内容\n
-        Disk -> 获得存储空间使用量、剩余空间大小
+        DeleteMany -> 批量删除多个文件的内容\n
+        FirstBlock -> 将首盘块号转换为整数并检查是否已分配\n
+        SetDirty -> 标记目录树被修改过\n
+        IsDirty -> 上次保存之后是否被修改过\n
+        Disk -> 获得存储空间使用量、剩余空间大小\n
+        Usage -> 统计文件大小之和、逻辑占用盘块数和实际占用盘块数
     """
 
-    def __init__(self):
-        """文件系统初始化"""
+    def __init__(self, storage_path: str = None, storage_offset: int = 0, storage_private: bool = False):
+        """
+        文件系统初始化\n
+        storage_path为存储空间映射的本地文件，storage_offset为映射区域的起始位置，默认只存放在内存中，
+        storage_private为True时为私有映射，写入不会写回本地文件
+        """
         self.BitMap = BitMap()  # 创建位示图
-        self.Storage = Storage()  # 创建存储
+        self.Storage = Storage(storage_path, storage_offset, storage_private)  # 创建存储
         self.FAT = FAT()  # 创建FAT表
         self.CtUser = User(b'root')  # 创建当前用户
         self.RootDir = Dir(b'home', b'', None)  # 创建根目录
-        self.CtDir = self.RootDir  # 当前目录
-
+        self.Snapshots = {}  # 快照
+        self.Dedup = DedupIndex()  # 去重索引
+        self.Compress = False  # 新建的文件是否压缩
+        self.Size = 0  # 所有文件的大小之和
+        self.DefaultDir = self.RootDir  # 不在会话中时的当前目录
+        self.Session = threading.local()  # 当前线程正在执行的会话
+        self.PathCache = PathCache()  # 路径解析缓存
+        self.ImagePath = None  # 已同步的镜像文件
+        self.ImageTables = [None, None]  # 镜像文件两个表区中现有的内容
+        self.MetaDirty = True  # 目录树是否被修改过
+        self.Journal = None  # 操作日志
+        self.JournalSeq = 0  # 镜像文件中已包含的最后一条操作日志的序号
+
+    @property
+    def CtDir(self) -> Dir:
+        """当前目录，线程在执行某个会话的命令时为该会话的当前目录"""
+        return getattr(self.Session, 'CtDir', self.DefaultDir)
+
+    @CtDir.setter
+    def CtDir(self, directory: Dir) -> None:
+        if hasattr(self.Session, 'CtDir'):
+            self.Session.CtDir = directory
+        else:
+            self.DefaultDir = directory
+
+    @timed('fs.write')
     def Write(self, data: bytes) -> int:
         """
         写入指定数据，返回写入的第一个盘块号
@@ -240,103 +764,703 @@ class FileSystem:
         :param data: 要写入的数据
         :return: 写入的第一个盘块号
         """
-        # 计算需要的盘块数
-        BlockAmt = math.ceil(len(data) / BLOCK_SIZE)
+        # 分盘块写入数据，不满一块算占一块盘块
+        Blocks = self.WriteBlocks(data)
 
         # 判断剩下的盘块是否够用
-        if BlockAmt > self.BitMap.EmptyBlockAMT():
+        if Blocks is None:
             return -1
 
-        # 分盘块写入数据，不满一块算占一块盘块
-        # 一个文件的写入是一个不可分的操作，需要写锁
-        AcquireLock()
+        # 返回第一个存储盘块号
+        return Blocks[0] if Blocks else 0
 
-        FirstWrite = 0
-        for WriteRank in range(BlockAmt):
-            BlockNum = self.BitMap.GetEmptyBlock()
+    def WriteBlocks(self, data: bytes, hint: int = None) -> (list | None):
+        """
+        分配盘块并写入数据，将这些盘块连成一条以结束符结尾的FAT链，返回盘块号列表
 
-            # 写入数据
-            self.Storage.Write(BlockNum, data[WriteRank * BLOCK_SIZE:] if WriteRank == BlockAmt - 1 else data[WriteRank * BLOCK_SIZE: (WriteRank + 1) * BLOCK_SIZE])
-            # 将位示图对应标签置1
-            self.BitMap.Write(BlockNum, 1)
-            # 更新FAT表
-            self.FAT.AddEntry(IntToHexStr(BlockNum))
+        优先分配从hint开始的连续盘块，若盘块数不足则返回None
+        """
+        BlockAmt = math.ceil(len(data) / BLOCK_SIZE)
+        if BlockAmt == 0:
+            return []
+        if self.Dedup.Enabled:
+            return self.WriteDedup(data, hint)
+
+        # 分配盘块是一个不可分的操作，需要分配锁
+        with AllocLock:
+            if BlockAmt > self.BitMap.EmptyBlockAMT():
+                return None
+
+            Blocks = self.BitMap.Allocate(BlockAmt, hint)
+            for WriteRank, BlockNum in enumerate(Blocks):
+                # 更新FAT表，此盘块指向下一盘块，最后一块为结束标志
+                self.FAT.SetEntry(BlockNum, Blocks[WriteRank + 1] if WriteRank < BlockAmt - 1 else FAT_END_FLAG)
+
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_written', len(data))
+        # 新分配的盘块只有调用者能看到，写入数据不需要持锁，每段连续的盘块一次写入
+        Written = 0
+        for Start, Amount in BlockRuns(Blocks):
+            self.Storage.WriteRun(Start, data[Written: Written + Amount * BLOCK_SIZE])
+            Written += Amount * BLOCK_SIZE
+
+        return Blocks
+
+    def WriteDedup(self, data: bytes, hint: int = None) -> (list | None):
+        """
+        去重写入，返回值与WriteBlocks相同
 
-            # 找到首个写入盘块的盘块号
-            if WriteRank == 0:
-                FirstWrite = BlockNum
+        从最后一块开始向前，内容和后继都与已有盘块相同的块直接共用已有盘块，其余的块分配新盘块写入，
+        写完后再记入去重索引
+        """
+        Chunks = [data[Offset: Offset + BLOCK_SIZE] for Offset in range(0, len(data), BLOCK_SIZE)]
+        Digests = [self.Dedup.Digest(Chunk) for Chunk in Chunks]
+
+        with AllocLock:
+            # 可以共用的后缀
+            Rank, NextBlock, Shared = len(Chunks), FAT_END_FLAG, []
+            while Rank > 0:
+                BlockNum = self.Dedup.Find(Digests[Rank - 1], NextBlock)
+                if BlockNum is None or self.Storage.Read(BlockNum) != Chunks[Rank - 1]:
+                    break
+                Rank -= 1
+                Shared.append(BlockNum)
+                NextBlock = BlockNum
+
+            if Rank > self.BitMap.EmptyBlockAMT():
+                return None
+            self.BitMap.Share(Shared)
+            Blocks = self.BitMap.Allocate(Rank, hint) if Rank else []
+            for WriteRank, BlockNum in enumerate(Blocks):
+                self.FAT.SetEntry(BlockNum, Blocks[WriteRank + 1] if WriteRank < Rank - 1 else NextBlock)
+
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_written', len(data))
+            metrics.Count('dedup.blocks_shared', len(Shared))
+        Written = 0
+        for Start, Amount in BlockRuns(Blocks):
+            self.Storage.WriteRun(Start, data[Written: Written + Amount * BLOCK_SIZE])
+            Written += Amount * BLOCK_SIZE
+
+        with AllocLock:
+            for WriteRank, BlockNum in enumerate(Blocks):
+                self.Dedup.Add(BlockNum, Digests[WriteRank], self.FAT.ReadEntry(BlockNum))
+
+        return Blocks + Shared[::-1]
+
+    @resized
+    def WriteFile(self, file: File, data: bytes) -> bool:
+        """
+        用data覆盖文件内容，不超过INLINE_SIZE的内容内嵌在文件记录中，压缩文件按帧压缩后写入
 
-        # 增加结束标志
-        self.FAT.AddEndFlag()
+        先写入新的盘块再释放原来的盘块，若盘块数不足则返回False，文件不变
+        """
+        if len(data) <= INLINE_SIZE:
+            self.Delete(file.address)
+            file.address, file.Blocks, file.Extents, file.size = None, None, None, 0
+            file.Inline = None
+            if file.Frames is not None:
+                file.Frames = []
+            return self.WriteInline(file, 0, data)
+
+        Temp = File(file.name, file.path)
+        if file.Frames is None:
+            FirstWrite = self.Write(data)
+            if FirstWrite == -1:
+                return False
+            if data:
+                Temp.Write(FirstWrite, len(data))
+        else:
+            Temp.Frames = []
+            if not self.WriteFrames(Temp, 0, data):
+                return False
 
-        ReleaseLock()
+        self.Delete(file.address)
+        file.address, file.Blocks, file.Extents, file.Frames = Temp.address, Temp.Blocks, None, Temp.Frames
+        file.Inline = None
+        file.size = len(data)
+        file.LastTime = GetCurrentTime()
+        return True
 
-        # 返回第一个存储盘块号
-        return FirstWrite
+    @resized
+    def WriteInline(self, file: File, offset: int, data: bytes) -> bool:
+        """
+        从内嵌文件（或空文件）的offset处写入数据，不需要分配盘块
 
-    def Read(self, first_block: str) -> bytes:
+        写入后超过INLINE_SIZE时转为存放在盘块中，若盘块数不足则返回False，文件不变
         """
-        根据输入的首盘块号开始读取 FAT 表，直到读到 ’FFFF‘
+        Old = file.Inline or b''
+        if offset > len(Old):
+            Old += bytes(offset - len(Old))
+        New = Old[:offset] + data + Old[offset + len(data):]
+        if len(New) <= INLINE_SIZE:
+            file.Inline = New or None
+            file.size = len(New)
+            file.LastTime = GetCurrentTime()
+            # 内容在文件记录中，没有写入任何盘块，需要标记目录树被修改过，保存时才会写入
+            self.SetDirty()
+            return True
+
+        # 转为存放在盘块中
+        if file.Frames is not None:
+            Inline, Size = file.Inline, file.size
+            file.Inline, file.size = None, 0
+            if not self.WriteFrames(file, 0, New):
+                file.Inline, file.size = Inline, Size
+                return False
+        else:
+            FirstWrite = self.Write(New)
+            if FirstWrite == -1:
+                return False
+            file.Inline = None
+            file.Write(FirstWrite, len(New))
+        if metrics.ENABLED:
+            metrics.Count('inline.promoted')
+        return True
 
-        :param first_block: 首盘块号
-        :return: 读取的文件内容
+    @resized
+    def Append(self, file: File, data: bytes) -> bool:
         """
-        # 找到目标表项
-        place = 0
-        while self.FAT.ReadEntry(place) != first_block:
-            # 没找到
-            if place == len(self.FAT.FAT) - 4:
-                return b''
-            place += FAT_ENTRY_SIZE
+        在文件末尾追加数据，先填满最后一个盘块的剩余空间，再把新的盘块接到FAT链末尾
 
-        # 读取文件内容
-        data_bin = b''
-        while True:
-            StoragePlace = HexStrToInt(self.FAT.ReadEntry(place))
+        之前的盘块不会被改动，若盘块数不足则返回False
+        :param file: 要追加的文件
+        :param data: 要追加的数据
+        :return: 是否追加成功
+        """
+        if file.Inline is not None or file.size == 0:
+            return self.WriteInline(file, file.size, data)
+        if file.Frames is not None:
+            return self.WriteFrames(file, file.size, data)
+        Blocks = self.FindBlocks(file)
+
+        # 空文件，直接写入
+        if len(Blocks) == 0:
+            FirstWrite = self.Write(data)
+            if FirstWrite == -1:
+                return False
+            file.Write(FirstWrite, len(data))
+            return True
+
+        # 要修改最后一个盘块，先解除与其他文件的共用
+        if data and not self.Unshare(file, len(Blocks) - 1):
+            return False
+
+        # 最后一个盘块的剩余空间
+        LastBlock = Blocks[-1]
+        Used = self.Storage.Length[LastBlock]
+        Free = BLOCK_SIZE - Used
+
+        # 放不下的数据写入新的盘块，判断剩下的盘块是否够用
+        NewBlocks = self.WriteBlocks(data[Free:], LastBlock + 1 if LastBlock < BLOCK_END else None)
+        if NewBlocks is None:
+            return False
+
+        # 填满最后一个盘块，并把新的盘块接到原来的FAT链末尾
+        self.Storage.Write(LastBlock, data[:Free], Used)
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_written', len(data[:Free]))
+        if NewBlocks:
+            self.FAT.SetEntry(LastBlock, NewBlocks[0])
+            Blocks.extend(NewBlocks)
+            file.Extents = None
+
+        file.size += len(data)
+        file.LastTime = GetCurrentTime()
+        return True
 
-            # 读到了结束符
-            if StoragePlace == HexStrToInt(FAT_END_FLAG):
-                return data_bin
+    @timed('fs.read')
+    def ReadAt(self, file: File, offset: int, length: int) -> bytes:
+        """
+        读取文件中从offset开始的length个字节，超出文件末尾的部分不读取
 
-            # 连接二进制数据
-            data_bin += self.Storage.Read(StoragePlace)
-            place += FAT_ENTRY_SIZE
+        通过文件记录的盘块号列表直接定位到第 offset // BLOCK_SIZE 个盘块，不需要沿FAT链查找
+        """
+        End = min(offset + length, file.size)
+        if offset >= End:
+            Data = b''
+        elif file.Inline is not None:
+            Data = file.Inline[offset: End]
+        elif file.Frames is not None:
+            FirstFrame = offset // FRAME_SIZE
+            Data = self.ReadFrames(file, FirstFrame, (End - 1) // FRAME_SIZE)
+            Data = Data[offset - FirstFrame * FRAME_SIZE: End - FirstFrame * FRAME_SIZE]
+        else:
+            Blocks = self.FindBlocks(file)
+            FirstRank, LastRank = offset // BLOCK_SIZE, (End - 1) // BLOCK_SIZE
+            Data = b''.join([self.Storage.Read(BlockNum) for BlockNum in Blocks[FirstRank: LastRank + 1]])
+            Data = Data[offset - FirstRank * BLOCK_SIZE: End - FirstRank * BLOCK_SIZE]
+
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_read', len(Data))
+        return Data
+
+    @resized
+    def WriteAt(self, file: File, offset: int, data: bytes) -> bool:
+        """
+        从文件的offset处开始覆盖写入数据，只改动涉及到的盘块
 
-    def Delete(self, first_block: str) -> bool:
-        """根据输入的首盘块号删除对应文件内容"""
+        offset超出文件末尾时，中间的部分以 0x00 填充；写入超出文件末尾的部分追加到文件中
+        若盘块数不足则返回False
+        """
+        if file.Inline is not None or file.size == 0:
+            return self.WriteInline(file, offset, data)
+        if file.Frames is not None:
+            return self.WriteFrames(file, offset, data)
+
+        # 超出文件末尾，补齐中间的空洞
+        if offset > file.size:
+            data = bytes(offset - file.size) + data
+            offset = file.size
+
+        # 分为覆盖原有内容的部分和追加的部分，先追加，盘块数不足时不做任何修改
+        Cover, Rest = data[: file.size - offset], data[file.size - offset:]
+        if Rest and not self.Append(file, Rest):
+            return False
+
+        # 要修改的盘块先解除与其他文件的共用
+        if Cover and not self.Unshare(file, (offset + len(Cover) - 1) // BLOCK_SIZE, offset // BLOCK_SIZE):
+            return False
+        Blocks = self.FindBlocks(file)
+
+        Written = 0
+        while Written < len(Cover):
+            Rank, InBlock = divmod(offset + Written, BLOCK_SIZE)
+            Piece = Cover[Written: Written + BLOCK_SIZE - InBlock]
+            self.Storage.Write(Blocks[Rank], Piece, InBlock, truncate=False)
+            Written += len(Piece)
+
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_written', len(Cover))
+        file.LastTime = GetCurrentTime()
+        return True
 
-        # 找到盘块号
-        place = 0
-        while self.FAT.ReadEntry(place) != first_block:
-            # 没找到
-            if place == len(self.FAT.FAT):
+    def FindBlocks(self, file: File) -> list:
+        """返回文件占用的盘块号列表并记录在文件中，空文件返回空列表"""
+        if file.Blocks is None:
+            FirstBlock = self.FirstBlock(file.address)
+            file.Blocks = [] if FirstBlock is None else list(self.FAT.Chain(FirstBlock))
+
+        return file.Blocks
+
+    def FindExtents(self, file: File) -> list:
+        """返回文件占用的连续区段 (起始盘块号, 盘块数) 的列表并记录在文件中"""
+        if file.Extents is None:
+            file.Extents = list(BlockRuns(self.FindBlocks(file)))
+
+        return file.Extents
+
+    def ReadExtents(self, file: File):
+        """
+        按连续区段逐段返回文件内容，每次返回一个区段的memoryview
+
+        文件除最后一个盘块外都是满的，每个区段可以直接切片
+        """
+        for Start, Amount in self.FindExtents(file):
+            yield self.Storage.ReadRun(Start, Amount)
+
+    def ReadFile(self, file: File):
+        """
+        逐段返回文件内容，内嵌文件直接返回，不压缩的文件按连续区段返回，压缩文件逐帧解压后返回
+
+        读完（或不再读取）时记录读取的字节数和用时，用时不包括调用者处理每段内容的时间
+        """
+        if file.Inline is not None:
+            Chunks = iter((file.Inline,))
+        elif file.Frames is None:
+            Chunks = self.ReadExtents(file)
+        else:
+            Chunks = (self.ReadFrames(file, Index, Index) for Index in range(len(file.Frames)))
+
+        BytesRead, Elapsed = 0, 0.0
+        try:
+            while True:
+                Start = time.perf_counter()
+                Chunk = next(Chunks, None)
+                Elapsed += time.perf_counter() - Start
+                if Chunk is None:
+                    break
+                BytesRead += len(Chunk)
+                yield Chunk
+        finally:
+            if metrics.ENABLED:
+                metrics.Count('fs.bytes_read', BytesRead)
+                metrics.Observe('fs.read', Elapsed)
+
+    def ReadFrames(self, file: File, first: int, last: int) -> bytes:
+        """读取压缩文件的第first到第last帧并解压，只读取这几帧所在的盘块"""
+        Blocks = self.FindBlocks(file)
+        Rank = sum(Amount for Amount, _ in file.Frames[:first])
+        Data = []
+        for Amount, Packed in file.Frames[first: last + 1]:
+            Raw = b''.join([self.Storage.Read(BlockNum) for BlockNum in Blocks[Rank: Rank + Amount]])
+            Data.append(zlib.decompress(Raw) if Packed else Raw)
+            Rank += Amount
+        return b''.join(Data)
+
+    @resized
+    def WriteFrames(self, file: File, offset: int, data: bytes) -> bool:
+        """
+        从压缩文件的offset处开始写入数据，offset超出文件末尾时中间的部分以 0x00 填充
+
+        只解压、重新压缩涉及到的帧，并替换这几帧的盘块；若盘块数不足则返回False，文件不变
+        """
+        if offset > file.size:
+            data = bytes(offset - file.size) + data
+            offset = file.size
+        if not data:
+            return True
+
+        # 涉及到的帧，写入超出文件末尾时包括最后一帧之后新增的帧
+        FirstFrame = offset // FRAME_SIZE
+        LastFrame = min((offset + len(data) - 1) // FRAME_SIZE, len(file.Frames) - 1)
+        Old = self.ReadFrames(file, FirstFrame, LastFrame)
+        Start = offset - FirstFrame * FRAME_SIZE
+        New = Old[:Start] + data + Old[Start + len(data):]
+
+        Chunks, Frames = [], []
+        for FrameStart in range(0, len(New), FRAME_SIZE):
+            Frame = New[FrameStart: FrameStart + FRAME_SIZE]
+            Packed = zlib.compress(Frame)
+            # 压缩后不能少占盘块的帧不压缩
+            if -(-len(Packed) // BLOCK_SIZE) >= -(-len(Frame) // BLOCK_SIZE):
+                Packed = None
+            Raw = Frame if Packed is None else Packed
+            Frames.append((-(-len(Raw) // BLOCK_SIZE), Packed is not None))
+            Chunks.extend(Raw[Offset: Offset + BLOCK_SIZE] for Offset in range(0, len(Raw), BLOCK_SIZE))
+
+        First = sum(Amount for Amount, _ in file.Frames[:FirstFrame])
+        Last = First + sum(Amount for Amount, _ in file.Frames[FirstFrame: LastFrame + 1]) - 1
+        if not self.Splice(file, First, Last, Chunks):
+            return False
+
+        # 换成新的列表而不原地修改，保存时拍下的快照可以直接共用原来的列表
+        file.Frames = file.Frames[:FirstFrame] + Frames + file.Frames[LastFrame + 1:]
+        file.size = max(file.size, offset + len(data))
+        file.LastTime = GetCurrentTime()
+        if metrics.ENABLED:
+            metrics.Count('fs.bytes_written', len(data))
+            metrics.Count('compress.blocks_saved', -(-len(New) // BLOCK_SIZE) - len(Chunks))
+        return True
+
+    def Splice(self, file: File, first: int, last: int, chunks: list) -> bool:
+        """
+        将文件的第first到第last个盘块替换为依次写入chunks中各段数据的新盘块，first > last 时插入到第first个盘块之前，
+        调用前需要持有文件的写锁
+
+        各段数据不需要写满盘块；若盘块数不足则返回False，文件不变
+        """
+        Blocks = self.FindBlocks(file)
+        # 要释放的盘块和前一个盘块（修改FAT表项）不能与其他文件共用
+        Rank = max(last, first - 1)
+        if Rank >= 0 and not self.Unshare(file, Rank, max(first - 1, 0)):
+            return False
+        NextBlock = Blocks[last + 1] if last + 1 < len(Blocks) else FAT_END_FLAG
+
+        with AllocLock:
+            if len(chunks) > self.BitMap.EmptyBlockAMT():
+                return False
+            New = self.BitMap.Allocate(len(chunks), Blocks[first - 1] + 1 if first else None) if chunks else []
+            for WriteRank, BlockNum in enumerate(New):
+                self.FAT.SetEntry(BlockNum, New[WriteRank + 1] if WriteRank < len(New) - 1 else NextBlock)
+
+        # 新分配的盘块只有此文件能看到，写入数据不需要持锁
+        for BlockNum, Chunk in zip(New, chunks):
+            self.Storage.Write(BlockNum, Chunk)
+
+        Head = New[0] if New else NextBlock
+        with AllocLock:
+            if first > 0:
+                self.FAT.SetEntry(Blocks[first - 1], Head)
+            else:
+                file.address = None if Head == FAT_END_FLAG else FillStr(IntToHexStr(Head), 4, '0', 0)
+            for BlockNum in Blocks[first: last + 1]:
+                if self.BitMap.Release(BlockNum):
+                    self.Dedup.Forget(BlockNum)
+                    self.FAT.DelEntry(BlockNum)
+                    self.Storage.Write(BlockNum, b'')
+
+        Blocks[first: last + 1] = New
+        file.Extents = None
+        return True
+
+    def Share(self, file: File) -> None:
+        """文件的所有盘块引用计数加1，之后可以由另一个文件使用同一首盘块号共用这些盘块，文件大小计入两次"""
+        with AllocLock:
+            self.BitMap.Share(self.FindBlocks(file))
+            self.Size += file.size
+
+    def Unshare(self, file: File, rank: int, first: int = None) -> bool:
+        """
+        修改文件的第first到第rank个盘块（first默认为rank）之前调用，将与其他文件共用的盘块复制一份，
+        调用前需要持有文件的写锁
+
+        一个盘块被共用时，FAT链上它之后的盘块也都被共用，所以只需复制从第一个共用的盘块到第rank个盘块，
+        复制的最后一块接回原来的FAT链；若盘块数不足则返回False
+        """
+        Blocks = self.FindBlocks(file)
+        with AllocLock:
+            First = rank + 1
+            while First > 0 and self.BitMap.Refs[Blocks[First - 1]] > 1:
+                First -= 1
+            Amount = rank + 1 - First
+
+            # 原地修改的盘块（内容或FAT表项）不能再被去重共用
+            for BlockNum in Blocks[rank if first is None else first: First]:
+                self.Dedup.Forget(BlockNum)
+            if Amount and First:
+                self.Dedup.Forget(Blocks[First - 1])
+
+            if Amount == 0:
+                return True
+            if Amount > self.BitMap.EmptyBlockAMT():
+                return False
+
+            Copies = self.BitMap.Allocate(Amount, Blocks[First - 1] + 1 if First else None)
+            for Rank, BlockNum in enumerate(Copies):
+                self.FAT.SetEntry(BlockNum, Copies[Rank + 1] if Rank < Amount - 1 else self.FAT.ReadEntry(Blocks[rank]))
+
+        # 新分配的盘块只有此文件能看到，复制数据不需要持锁
+        for Old, New in zip(Blocks[First: rank + 1], Copies):
+            self.Storage.Write(New, self.Storage.Read(Old))
+
+        with AllocLock:
+            if First == 0:
+                file.address = FillStr(IntToHexStr(Copies[0]), 4, '0', 0)
+            else:
+                self.FAT.SetEntry(Blocks[First - 1], Copies[0])
+            for BlockNum in Blocks[First: rank + 1]:
+                if self.BitMap.Release(BlockNum):
+                    self.Dedup.Forget(BlockNum)
+                    self.FAT.DelEntry(BlockNum)
+                    self.Storage.Write(BlockNum, b'')
+
+        Blocks[First: rank + 1] = Copies
+        file.Extents = None
+        if metrics.ENABLED:
+            metrics.Count('cow.blocks_copied', Amount)
+        return True
+
+    def Exclusive(self, files: list) -> int:
+        """files中各文件的盘块里，没有被其他文件共用的盘块数，删除这些文件时会释放这些盘块"""
+        Count = {}
+        for file in files:
+            for BlockNum in self.FindBlocks(file):
+                Count[BlockNum] = Count.get(BlockNum, 0) + 1
+        return sum(1 for BlockNum, Amount in Count.items() if self.BitMap.Refs[BlockNum] == Amount)
+
+    def Relocate(self, file: File) -> bool:
+        """
+        将文件移动到一段连续的盘块中，优先使用靠前的空闲盘块，调用前需要持有文件的写锁
+
+        找不到足够长的连续空闲盘块或文件已经连续时不移动，返回是否移动了文件
+        """
+        # 与其他文件共用盘块的文件不移动，以免复制共用的盘块
+        if len(self.FindExtents(file)) < 2 or self.BitMap.Refs[file.Blocks[-1]] > 1:
+            return False
+        Amount = len(file.Blocks)
+
+        with AllocLock:
+            Start = self.BitMap.FindEmptyRun(Amount, BLOCK_STR)
+            if Start is None:
                 return False
-            place += FAT_ENTRY_SIZE
+            Blocks = self.BitMap.Allocate(Amount, Start)
+            for Rank, BlockNum in enumerate(Blocks[:-1]):
+                self.FAT.SetEntry(BlockNum, Blocks[Rank + 1])
+            self.FAT.SetEntry(Blocks[-1])
+
+        # 先复制内容，再修改文件的首盘块号，最后释放原来的盘块
+        if file.Frames is None:
+            self.Storage.WriteRun(Start, b''.join(self.ReadExtents(file)))
+        else:
+            # 压缩文件中间的盘块不一定是满的，逐块复制
+            for Old, New in zip(file.Blocks, Blocks):
+                self.Storage.Write(New, self.Storage.Read(Old))
+        OldAddress = file.address
+        file.address = FillStr(IntToHexStr(Start), 4, '0', 0)
+        file.Blocks = Blocks
+        file.Extents = None
+        self.Delete(OldAddress)
+        if metrics.ENABLED:
+            metrics.Count('defrag.blocks_moved', Amount)
+        return True
 
-        # 删除为原子操作，申请写锁
-        AcquireLock()
+    def Fragmentation(self, files: list) -> dict:
+        """统计files中各文件占用的区段数（空文件不计）以及空闲空间的连续区间，调用前需要持有卷的读锁"""
+        Extents = []
+        for file in files:
+            with file.Lock.Read():
+                Amount = len(self.FindExtents(file))
+            if Amount:
+                Extents.append(Amount)
+        with AllocLock:
+            FreeRuns = self.BitMap.FreeRuns()
+        return {
+            'files': len(Extents),
+            'fragmented_files': sum(1 for Amount in Extents if Amount > 1),
+            'extents': sum(Extents),
+            'extents_per_file': round(sum(Extents) / len(Extents), 2) if Extents else 0.0,
+            'max_extents': max(Extents, default=0),
+            'free_blocks': self.BitMap.EmptyBlockAMT(),
+            'free_runs': len(FreeRuns),
+            'largest_free_run': max((Amount for _, Amount in FreeRuns), default=0),
+        }
+
+    @timed('fs.read')
+    def Read(self, first_block: str) -> bytes:
+        """
+        根据输入的首盘块号开始沿 FAT 表读取，直到读到结束符 0xFFFF
 
-        # 删除
-        while self.FAT.ReadEntry(place) != FAT_END_FLAG:
-            BlockNum = HexStrToInt(self.FAT.ReadEntry(place))
+        :param first_block: 首盘块号
+        :return: 读取的文件内容
+        """
+        # join 会先算出总长度，只分配一次
+        return b''.join(self.ReadStream(first_block))
+
+    def ReadStream(self, first_block: str):
+        """
+        根据输入的首盘块号沿 FAT 表逐块返回文件内容，每次返回一个盘块的memoryview
 
-            # 删除FAT表
-            self.FAT.DelEntry(place)
-            # 将位示图对应标签置0
-            self.BitMap.Write(BlockNum, 0)
-            # 删除数据（此处是否更改sys.Storage对结果没有影响）
-            self.Storage.Write(BlockNum, b'')
+        :param first_block: 首盘块号
+        """
+        # 首盘块未分配，说明是空文件
+        FirstBlock = self.FirstBlock(first_block)
+        if FirstBlock is None:
+            return
 
-        # 删除FAT表结束标志
-        self.FAT.DelEntry(place)
+        # 盘块号连续且前一个盘块是满的，合并为一段一起返回
+        BytesRead = 0
+        RunStart, RunAmount = FirstBlock, 0
+        try:
+            for BlockNum in self.FAT.Chain(FirstBlock):
+                if BlockNum == RunStart + RunAmount and (RunAmount == 0 or self.Storage.Length[BlockNum - 1] == BLOCK_SIZE):
+                    RunAmount += 1
+                    continue
+                Chunk = self.Storage.ReadRun(RunStart, RunAmount)
+                BytesRead += len(Chunk)
+                yield Chunk
+                RunStart, RunAmount = BlockNum, 1
+            Chunk = self.Storage.ReadRun(RunStart, RunAmount)
+            BytesRead += len(Chunk)
+            yield Chunk
+        finally:
+            if metrics.ENABLED:
+                metrics.Count('fs.bytes_read', BytesRead)
+
+    def ReadInto(self, first_block: str, buffer) -> int:
+        """
+        根据输入的首盘块号将文件内容依次写入buffer中，返回写入的字节数
 
-        ReleaseLock()
+        :param first_block: 首盘块号
+        :param buffer: 可写的缓冲区（如bytearray），大小不小于文件大小
+        :return: 写入的字节数
+        """
+        View = memoryview(buffer)
+        Offset = 0
+        for Chunk in self.ReadStream(first_block):
+            View[Offset: Offset + len(Chunk)] = Chunk
+            Offset += len(Chunk)
+        return Offset
+
+    @timed('fs.delete')
+    def Delete(self, first_block: str) -> bool:
+        """根据输入的首盘块号删除对应文件内容"""
+        # 找到盘块号
+        FirstBlock = self.FirstBlock(first_block)
+        if FirstBlock is None:
+            return False
+
+        # 释放盘块为原子操作，申请分配锁
+        with AllocLock:
+            BlockNum = FirstBlock
+            Freed = 0
+            while BlockNum != FAT_END_FLAG:
+                NextBlock = self.FAT.ReadEntry(BlockNum)
+
+                # 引用计数减1，还有其他文件共用时保留
+                if self.BitMap.Release(BlockNum):
+                    self.Dedup.Forget(BlockNum)
+                    # 删除FAT表
+                    self.FAT.DelEntry(BlockNum)
+                    # 删除数据（此处是否更改sys.Storage对结果没有影响）
+                    self.Storage.Write(BlockNum, b'')
+                    Freed += 1
+
+                BlockNum = NextBlock
+
+        if metrics.ENABLED:
+            metrics.Count('blocks.freed', Freed)
         return True
 
+    @timed('fs.delete_many')
+    def DeleteMany(self, files: list) -> int:
+        """
+        批量删除多个文件的内容，文件大小不再计入文件大小之和，返回释放的盘块数
+
+        先沿FAT表收集所有盘块，再在一次持有分配锁期间全部释放，还有其他文件共用的盘块保留
+        """
+        Firsts = [BlockNum for BlockNum in (self.FirstBlock(file.address) for file in files) if BlockNum is not None]
+
+        with AllocLock:
+            self.Size -= sum(file.size for file in files)
+            Blocks = [BlockNum for FirstBlock in Firsts for BlockNum in self.FAT.Chain(FirstBlock)]
+            Freed = 0
+            for BlockNum in Blocks:
+                if self.BitMap.Release(BlockNum):
+                    self.Dedup.Forget(BlockNum)
+                    self.FAT.DelEntry(BlockNum)
+                    self.Storage.Write(BlockNum, b'')
+                    Freed += 1
+
+        if metrics.ENABLED:
+            metrics.Count('blocks.freed', Freed)
+        return Freed
+
+    def FirstBlock(self, first_block: str) -> (int | None):
+        """将首盘块号转换为整数，若为空或该盘块未分配则返回None"""
+        if first_block is None:
+            return None
+
+        BlockNum = HexStrToInt(first_block)
+        if not BLOCK_STR <= BlockNum <= BLOCK_END or self.FAT.ReadEntry(BlockNum) == FAT_FREE_FLAG:
+            return None
+        return BlockNum
+
+    def SetDirty(self) -> None:
+        """标记目录树被修改过，下次保存时需要写入元数据"""
+        self.MetaDirty = True
+
+    def IsDirty(self) -> bool:
+        """上次保存之后 目录树 或 盘块 是否被修改过"""
+        return self.MetaDirty or len(self.Storage.Dirty) > 0
+
     def Disk(self) -> (float, float):
         """返回存储空间使用量，剩余空间大小（KB）"""
         return round((1 - (self.BitMap.EmptyBlockAMT() / (BLOCK_END - BLOCK_STR + 1))), 4), self.BitMap.EmptyBlockAMT() / 4
 
+    def Usage(self) -> (int, int, int):
+        """
+        返回 (所有文件的大小之和, 所有文件的盘块数之和, 已分配的盘块数)，都由维护的计数得到
+
+        复制、快照和去重共用的盘块在第二项中重复计算，第二项与第三项之比即共用盘块节省的倍数
+        """
+        with AllocLock:
+            return self.Size, self.BitMap.Logical, BLOCK_END - BLOCK_STR + 1 - self.BitMap.EmptyBlockAMT()
+
+
+def BlockRuns(blocks: list):
+    """将盘块号合并为连续的区间，依次返回 (起始盘块号, 盘块数)"""
+    Start, Amount = None, 0
+    for BlockNum in blocks:
+        if Start is not None and BlockNum == Start + Amount:
+            Amount += 1
+            continue
+        if Start is not None:
+            yield Start, Amount
+        Start, Amount = BlockNum, 1
+    if Start is not None:
+        yield Start, Amount
+
 
 def IntToHexStr(num: int) -> str:
     """将输入的整形数字转换为16进制字符串"""
@@ -366,13 +1490,13 @@ def GetCurrentTime() -> bytes:
 
 
 def AcquireLock():
-    """请求锁"""
-    WriteLock.acquire()
+    """请求卷的写锁"""
+    VolumeLock.AcquireWrite()
 
 
 def ReleaseLock():
-    """释放锁"""
-    WriteLock.release()
+    """释放卷的写锁"""
+    VolumeLock.ReleaseWrite()
 
 
 def FillStr(str1: str, length: int, str2: str, flag=1) -> str:
@@ -0,0 +1,390 @@
+"""
+性能测试\n
+用参数化的负载测试 basic.FileSystem 和 core.Command：在一个目录中创建文件、深层路径查找、大文件读写、
+反复追加、读写小文件、删除大目录树、保存和加载镜像文件、查看磁盘使用量，以及多线程读写和多客户端服务器\n
+每种负载输出每秒操作数、延迟分位数和峰值内存，结果以JSON格式输出，可以与之前的结果对比
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from io import StringIO
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, perf_counter_ns
+import argparse
+import asyncio
+import platform
+import random
+import json
+import os
+import sys as _sys
+import tracemalloc
+
+from basic import FileSystem, VolumeLock, BLOCK_STR, BLOCK_END
+from core import Command, GetFile, GetTarget
+from journal import Journal
+from server import Server, END
+import FileSystem as Main
+
+FILE_AMT = 32  # 测试文件个数
+FILE_SIZE = 4096  # 测试文件的初始大小
+RECORD_SIZE = 16  # 每次追加的记录大小
+DURATION = 1.0  # 每种线程数的测试时长（秒）
+THREAD_AMTS = (1, 2, 4, 8)  # 测试的线程数
+CLIENT_AMT = 100  # 同时连接服务器的客户端数
+SEED = 2022  # 随机数种子，保证每次运行的负载相同
+
+
+class Recorder:
+    """
+    记录每种操作每次的用时，包括
+
+    方法：
+        Time -> 执行一次操作并记录用时\n
+        Add -> 记录一次在别处计时的操作的用时\n
+        Summary -> 每种操作的次数、每秒操作数以及延迟分位数
+    """
+    def __init__(self):
+        self.Latencies = {}  # 操作名 -> 每次的用时（纳秒）
+
+    def Time(self, name: str, func, *args):
+        """执行 func(*args) 并记录用时，返回 func 的返回值"""
+        Start = perf_counter_ns()
+        Result = func(*args)
+        self.Add(name, perf_counter_ns() - Start)
+        return Result
+
+    def Add(self, name: str, elapsed: int) -> None:
+        """记录一次用时elapsed（纳秒），多个线程可以同时记录"""
+        self.Latencies.setdefault(name, []).append(elapsed)
+
+    def Summary(self) -> dict:
+        Result = {}
+        for Name, Latencies in self.Latencies.items():
+            Latencies = sorted(Latencies)
+            Total = sum(Latencies)
+            Result[Name] = {
+                'count': len(Latencies),
+                'ops_per_sec': round(len(Latencies) / Total * 1e9, 1) if Total else None,
+                'p50_us': Percentile(Latencies, 50),
+                'p90_us': Percentile(Latencies, 90),
+                'p99_us': Percentile(Latencies, 99),
+                'max_us': round(Latencies[-1] / 1e3, 2),
+            }
+        return Result
+
+
+def Percentile(latencies: list, percent: float) -> float:
+    """有序的用时列表的百分位数（微秒）"""
+    Index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+    return round(latencies[Index] / 1e3, 2)
+
+
+def Quiet(func, *args):
+    """执行时丢弃输出"""
+    with redirect_stdout(StringIO()):
+        return func(*args)
+
+
+def CreateFiles(rec: Recorder, files: int = 5000) -> None:
+    """在同一个目录中创建files个文件"""
+    cmd = Command(FileSystem())
+    cmd.CreateObj('dir', 'dir')
+    for index in range(files):
+        rec.Time('touch', cmd.CreateObj, 'dir/f%d' % index)
+
+
+def DeepLookup(rec: Recorder, depth: int = 32, lookups: int = 20000) -> None:
+    """建立depth层的目录，随机查找其中各层的目录，第一次查找时路径不在缓存中"""
+    sys = FileSystem()
+    cmd = Command(sys)
+    Path = ''
+    for level in range(depth):
+        Path += '/d%d' % level
+        cmd.CreateObj(Path, 'dir')
+    Names = Path.split('/')
+    Random = random.Random(SEED)
+    sys.PathCache.InvalidateTree(sys.RootDir.path)
+    for _ in range(lookups):
+        rec.Time('lookup', GetTarget, sys, '/'.join(Names[:Random.randint(2, depth + 1)]))
+
+
+def LargeFile(rec: Recorder, size: int = 1024 * 1024, rounds: int = 20) -> None:
+    """反复写入、读取、删除size字节的大文件"""
+    sys = FileSystem()
+    Data = bytes(random.Random(SEED).getrandbits(8) for _ in range(4096)) * (size // 4096)
+    for _ in range(rounds):
+        First = rec.Time('write', sys.Write, Data)
+        Address = '%04x' % First
+        if rec.Time('read', sys.Read, Address) != Data:
+            raise AssertionError('读出的内容与写入的不一致')
+        rec.Time('delete', sys.Delete, Address)
+
+
+def Append(rec: Recorder, appends: int = 20000, record: int = 100) -> None:
+    """向同一个文件反复追加record字节"""
+    sys = FileSystem()
+    cmd = Command(sys)
+    cmd.CreateObj('f')
+    Target = GetFile(sys, 'f')
+    Data = b'x' * record
+    for _ in range(appends):
+        rec.Time('append', sys.Append, Target, Data)
+    if Target.size != appends * record:
+        raise AssertionError('追加后的文件大小不正确')
+
+
+def SmallFiles(rec: Recorder, files: int = 5000, size: int = 60) -> dict:
+    """写入并读取files个size字节的小文件，返回占用的盘块数"""
+    sys = FileSystem()
+    cmd = Command(sys)
+    cmd.CreateObj('dir', 'dir')
+    Data = 'x' * size
+    for index in range(files):
+        cmd.CreateObj('dir/f%d' % index)
+        rec.Time('write', cmd.cat, [Data, '>', 'dir/f%d' % index])
+    for index in range(files):
+        Target = GetFile(sys, 'dir/f%d' % index)
+        if rec.Time('read', sys.ReadAt, Target, 0, size) != Data.encode():
+            raise AssertionError('读出的内容与写入的不一致')
+    return {'blocks_used': BLOCK_END - BLOCK_STR + 1 - sys.BitMap.EmptyBlockAMT()}
+
+
+def RemoveTree(rec: Recorder, dirs: int = 50, files: int = 40, rounds: int = 5) -> None:
+    """反复建立dirs个子目录、每个子目录files个文件的目录树，再递归删除"""
+    sys = FileSystem()
+    cmd = Command(sys)
+    for _ in range(rounds):
+        cmd.CreateObj('/tree', 'dir')
+        for index in range(dirs):
+            cmd.CreateObj('/tree/d%d' % index, 'dir')
+            for num in range(files):
+                cmd.CreateObj('/tree/d%d/f%d' % (index, num))
+                cmd.cat(['data', '>', '/tree/d%d/f%d' % (index, num)])
+        rec.Time('rmdir', Quiet, cmd.rmdir, '/tree', False)
+
+
+def SaveLoad(rec: Recorder, full: bool = True, rounds: int = 3) -> None:
+    """保存并加载镜像文件，full为True时先写满整个存储空间，每次都完整地保存"""
+    sys = FileSystem()
+    if full:
+        while sys.Write(b'x' * 64 * 1024) != -1:
+            pass
+    OldPath = Main.PATH
+    with TemporaryDirectory() as Dir:
+        Main.PATH = Dir + '/'
+        try:
+            for _ in range(rounds):
+                sys.ImagePath = None
+                rec.Time('save', Main.SaveSys, sys)
+                rec.Time('load', Main.LoadSys)
+        finally:
+            Main.PATH = OldPath
+
+
+def Disk(rec: Recorder, calls: int = 100000) -> None:
+    """反复执行 disk 命令查看存储空间使用情况"""
+    sys = FileSystem()
+    cmd = Command(sys)
+    cmd.CreateObj('f')
+    sys.WriteFile(GetFile(sys, 'f'), b'x' * 1024 * 1024)
+    for _ in range(calls):
+        rec.Time('disk', Quiet, cmd.disk)
+
+
+def Record(index: int) -> bytes:
+    """第index个文件的记录，文件内容由这一记录重复组成"""
+    return ('%-15d\n' % index).encode()
+
+
+def Setup() -> FileSystem:
+    """新建一个文件系统，在根目录下创建FILE_AMT个测试文件"""
+    sys = FileSystem()
+    Cmd = Command(sys)
+    for index in range(FILE_AMT):
+        Cmd.CreateObj('f%d' % index)
+        Target = GetFile(sys, 'f%d' % index)
+        sys.WriteFile(Target, Record(index) * (FILE_SIZE // RECORD_SIZE))
+    return sys
+
+
+def Check(index: int, data: bytes) -> None:
+    """检查第index个文件的内容由完整的记录组成"""
+    if len(data) % RECORD_SIZE or data != Record(index) * (len(data) // RECORD_SIZE):
+        raise AssertionError('文件 f%d 的内容损坏' % index)
+
+
+def Worker(rec: Recorder, sys: FileSystem, files: list, seed: int, deadline: float) -> int:
+    """随机读取文件，每读取8次通过 cat >> 命令追加一条记录，记录每次读取和追加的用时，返回读取次数"""
+    Random = random.Random(seed)
+    Cmd = Command(sys)
+    Reads = 0
+    while perf_counter() < deadline:
+        index = Random.randrange(FILE_AMT)
+        Target = files[index]
+        if Reads % 8 == 7:
+            rec.Time('append', Cmd.cat, [Record(index).decode(), '>>', '/f%d' % index])
+        Start = perf_counter_ns()
+        with VolumeLock.Read():
+            with Target.Lock.Read():
+                Data = b''.join(sys.ReadFile(Target))
+                Size = Target.size
+        rec.Add('read', perf_counter_ns() - Start)
+        if len(Data) != Size:
+            raise AssertionError('文件 f%d 的大小不一致' % index)
+        Check(index, Data)
+        Reads += 1
+    return Reads
+
+
+def Run(rec: Recorder, threads: int) -> dict:
+    """使用threads个线程测试DURATION秒，返回测试结果"""
+    sys = Setup()
+    Files = [GetFile(sys, 'f%d' % index) for index in range(FILE_AMT)]
+    Start = perf_counter()
+    with ThreadPoolExecutor(threads) as Pool:
+        Reads = sum(Pool.map(Worker, [rec] * threads, [sys] * threads, [Files] * threads, range(threads),
+                             [Start + DURATION] * threads))
+    Elapsed = perf_counter() - Start
+    # 结束后再检查一遍所有文件以及块的分配
+    for index, Target in enumerate(Files):
+        Check(index, b''.join(sys.ReadFile(Target)))
+    Used = sum(len(sys.FindBlocks(Target)) for Target in Files)
+    if Used != BLOCK_END - BLOCK_STR + 1 - sys.BitMap.EmptyBlockAMT():
+        raise AssertionError('已分配的块数与文件占用的块数不一致')
+    return {'threads': threads, 'reads': Reads, 'reads_per_sec': round(Reads / Elapsed, 1)}
+
+
+async def Client(rec: Recorder, path: str, index: int, deadline: float) -> int:
+    """一个客户端在自己的目录中反复追加、读取文件，记录每条命令从发送到收到输出的用时，返回执行的命令数"""
+    reader, writer = await asyncio.open_unix_connection(path)
+
+    async def Execute(line: str) -> bytes:
+        writer.write(line.encode() + b'\n')
+        Output = await reader.readuntil(END)
+        await reader.readline()
+        return Output
+
+    await reader.readuntil(END)
+    await reader.readline()
+    for Line in ('mkdir c%d' % index, 'cd c%d' % index, 'touch f'):
+        await Execute(Line)
+
+    Commands = 0
+    while perf_counter() < deadline:
+        for Name, Line in (('append', 'cat %d >> f' % index), ('cat', 'cat f'), ('ls', 'ls')):
+            Start = perf_counter_ns()
+            await Execute(Line)
+            rec.Add(Name, perf_counter_ns() - Start)
+        Commands += 3
+    await Execute('exit')
+    writer.close()
+    return Commands
+
+
+async def Clients(rec: Recorder, path: str, clients: int) -> int:
+    Deadline = perf_counter() + DURATION
+    return sum(await asyncio.gather(*[Client(rec, path, index, Deadline) for index in range(clients)]))
+
+
+def ServerRun(rec: Recorder, clients: int = CLIENT_AMT) -> dict:
+    """clients个客户端通过Unix域套接字同时连接服务器测试DURATION秒，操作日志写在临时目录中，返回测试结果"""
+    with TemporaryDirectory() as Dir:
+        sys = FileSystem()
+        sys.Journal = Journal(os.path.join(Dir, 'bench.journal'))
+        Path = os.path.join(Dir, 'bench.sock')
+
+        # 服务器在单独的线程中运行自己的事件循环
+        Loop = asyncio.new_event_loop()
+        server = Server(sys)
+        Loop.run_until_complete(server.Start(Path))
+        Runner = Thread(target=Loop.run_forever)
+        Runner.start()
+        try:
+            Start = perf_counter()
+            Commands = asyncio.run(Clients(rec, Path, clients))
+            Elapsed = perf_counter() - Start
+        finally:
+            asyncio.run_coroutine_threadsafe(server.Close(), Loop).result()
+            Loop.call_soon_threadsafe(Loop.stop)
+            Runner.join()
+            Loop.close()
+            sys.Journal.Close()
+    return {'clients': clients, 'commands': Commands, 'commands_per_sec': round(Commands / Elapsed, 1)}
+
+
+def Concurrent(rec: Recorder, threads: tuple = THREAD_AMTS) -> dict:
+    """多个线程同时读取和追加不同的文件，返回各线程数下每秒的读取次数"""
+    return {'threads': [Run(rec, amount) for amount in threads]}
+
+
+def ServerCommands(rec: Recorder, clients: int = CLIENT_AMT) -> dict:
+    """多个客户端同时连接服务器执行命令，返回每秒执行的命令数"""
+    return ServerRun(rec, clients)
+
+
+# 负载名 -> (负载函数, 默认参数)
+WORKLOADS = {
+    'create_files': (CreateFiles, {'files': 5000}),
+    'deep_lookup': (DeepLookup, {'depth': 32, 'lookups': 20000}),
+    'large_file': (LargeFile, {'size': 1024 * 1024, 'rounds': 20}),
+    'append': (Append, {'appends': 20000, 'record': 100}),
+    'small_files': (SmallFiles, {'files': 5000, 'size': 60}),
+    'remove_tree': (RemoveTree, {'dirs': 50, 'files': 40, 'rounds': 5}),
+    'save_load_full': (SaveLoad, {'full': True, 'rounds': 3}),
+    'save_load_empty': (SaveLoad, {'full': False, 'rounds': 3}),
+    'disk': (Disk, {'calls': 100000}),
+    'concurrent_read_append': (Concurrent, {'threads': THREAD_AMTS}),
+    'server_commands': (ServerCommands, {'clients': CLIENT_AMT}),
+}
+
+
+def RunWorkload(name: str, memory: bool = True) -> dict:
+    """
+    运行一种负载并返回结果
+
+    计时和测量峰值内存分两次运行，tracemalloc 的开销不会计入用时
+    """
+    func, params = WORKLOADS[name]
+    rec = Recorder()
+    Start = perf_counter()
+    Extra = func(rec, **params)
+    Result = {'workload': name, 'params': params, 'seconds': round(perf_counter() - Start, 3),
+              'ops': rec.Summary()}
+    if Extra:
+        Result.update(Extra)
+
+    if memory:
+        tracemalloc.start()
+        try:
+            func(Recorder(), **params)
+            Result['peak_memory_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        finally:
+            tracemalloc.stop()
+    return Result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='文件系统性能测试')
+    parser.add_argument('workloads', nargs='*', help='要运行的负载，默认全部运行：' + ', '.join(WORKLOADS.keys()))
+    parser.add_argument('--output', help='结果写入的文件，默认输出到标准输出')
+    parser.add_argument('--no-memory', action='store_true', help='不测量峰值内存')
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error('没有负载 ' + name)
+
+    Results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'workloads': [RunWorkload(name, not args.no_memory) for name in args.workloads or WORKLOADS.keys()],
+    }
+    if args.output is None:
+        json.dump(Results, _sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(Results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+连接到文件系统服务器的客户端，使用方法与直接运行 FileSystem.py 相同
+"""
+import argparse
+import socket
+
+from server import END
+
+
+class Client:
+    """
+    服务器的客户端，包括
+
+    属性：
+        CtDir(str) -> 会话的当前目录\n
+    方法：
+        Execute -> 发送一行命令，返回命令的输出\n
+        Close -> 断开连接
+    """
+    def __init__(self, path: str = None, host: str = '127.0.0.1', port: int = 8421):
+        """指定path时连接Unix域套接字，否则连接TCP端口"""
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rb')
+        self.CtDir = ''
+        self.Receive()
+
+    def Receive(self) -> str:
+        """读取一条命令的输出以及会话的当前目录"""
+        Output = bytearray()
+        while True:
+            Line = self.file.readline()
+            if not Line:
+                raise ConnectionError('连接已断开')
+            Index = Line.find(END)
+            if Index == -1:
+                Output += Line
+                continue
+            Output += Line[:Index]
+            self.CtDir = Line[Index + 1:].rstrip(b'\n').decode('utf-8')
+            return Output.decode('utf-8')
+
+    def Execute(self, line: str) -> str:
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+        return self.Receive()
+
+    def Close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文件系统客户端')
+    parser.add_argument('--unix', help='服务器的Unix域套接字路径')
+    parser.add_argument('--host', default='127.0.0.1', help='服务器的地址')
+    parser.add_argument('--port', type=int, default=8421, help='服务器的端口')
+    args = parser.parse_args()
+
+    client = Client(args.unix, args.host, args.port)
+    print(client.Execute('h'))
+    try:
+        while True:
+            print(f"\033[32m{client.CtDir}\033[0m", '# ', end='')
+            Input = input()
+            print(client.Execute(Input), end='')
+            if Input.split()[:1] == ['exit']:
+                break
+    except (EOFError, KeyboardInterrupt, ConnectionError):
+        print()
+    finally:
+        client.Close()
+
+
+if __name__ == '__main__':
+    main()
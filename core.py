@@ -1,8 +1,57 @@
 from __future__ import annotations
-from basic import File, Dir, FileSystem, FillStr, Encode, Decode, HELP_MSG
+from codecs import getincrementaldecoder
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from time import perf_counter, sleep
+from basic import File, Dir, FileSystem, FillStr, Encode, Decode, HELP_MSG, VolumeLock, BLOCK_SIZE
+from profiling import PROFILER
+import metrics
+import json
 
 
 NAME_SIZE_LIMIT = 8
+SNAP_PREFIX = b'@'  # 快照中目录/文件路径的前缀
+
+
+def journaled(record, exclusive: bool = False, target=None):
+    """
+    将此装饰器应用到会修改文件系统的Command方法上，执行后将 record(self, *args) 返回的参数写入操作日志\n
+    record 返回的第一个参数为目标的绝对路径，返回 None 表示这次调用不修改文件系统，只持有卷的读锁\n
+    exclusive为True（修改目录树）时持有卷的写锁，否则持有卷的读锁以及目标文件的写锁，
+    目标文件的路径由 target(Args) 给出，默认为 Args[0]；
+    执行和写日志都在持锁期间完成，同一文件上的操作在日志中的顺序与执行顺序一致，保存镜像文件也不会插在两者之间
+    """
+    def decorator(func):
+        @wraps(func)  # 复制原函数元信息
+        def wrapper(self, *args):
+            Args = record(self, *args)
+            if Args is None:
+                with VolumeLock.Read():
+                    return func(self, *args)
+
+            Journal = self.sys.Journal
+            with VolumeLock.Write() if exclusive else LockFile(self.sys, Args[0] if target is None else target(Args)):
+                # 执行时抛出异常的操作不写入日志，重做日志时不会再执行一遍
+                Result = func(self, *args)
+                Seq = Journal.Append(func.__name__, Args) if Journal is not None else 0
+            # 等待日志写入磁盘，批量执行时不等待，由后台线程成组写入
+            if Journal is not None and not Journal.Deferred:
+                Journal.Wait(Seq)
+            return Result
+
+        return wrapper
+
+    return decorator
+
+
+def read_locked(func):
+    """将此装饰器应用到只读取文件系统的Command方法上，执行期间持有卷的读锁"""
+    @wraps(func)  # 复制原函数元信息
+    def wrapper(self, *args):
+        with VolumeLock.Read():
+            return func(self, *args)
+
+    return wrapper
 
 
 class Command:
@@ -11,12 +60,21 @@ class Command:
         'h': '查看帮助',
         'touch': '新建一个空的文件并命名',
         'rm': '删除某个文件或目录',
+        'cp': '复制文件或目录（与原文件共用盘块，修改时再复制）',
         'ls': '查看当前目录下文件和目录',
         'mkdir': '新建目录',
         'rmdir': '移除目录',
         'cd': '进入某个子目录 或 回到根目录',
         'cat': '输出/追加/覆盖 文件内容',
+        'read': '从文件指定位置读取指定长度的内容',
+        'write': '从文件指定位置写入内容',
         'disk': '查看磁盘剩余空间',
+        'dedup': '开启/关闭写入时去重（dedup on/off）',
+        'compress': '压缩/解压文件，或设置新建的文件是否压缩',
+        'stats': '查看性能统计（stats on/off/reset/json）',
+        'prof': '分析命令的性能（prof next/slow/off/reset/dump）',
+        'defrag': '查看碎片情况 或 整理碎片（defrag run）',
+        'snap': '创建/查看/只读挂载/回滚/删除 快照',
         'exit': '退出系统'
     }
 
@@ -28,6 +86,7 @@ class Command:
         print("本系统包含以下基本命令：")
         print('\n'.join([FillStr(s, 6, ' ') + ': ' + self.command[s] for s in self.command.keys()]))
 
+    @journaled(lambda self, path, obj_type='file': [self.AbsPath(path), obj_type], exclusive=True)
     def CreateObj(self, path: str, obj_type: str = 'file' or 'dir') -> None:
         """新建一个子对象并命名，默认创建文件"""
 
@@ -35,33 +94,41 @@ class Command:
         name_bin = Encode(t_path[-1])
 
         try:
-            TargetFather = GetObjFromPath(StartDir, f_path)
+            _, TargetFather = ResolvePath(self.sys, StartDir, f_path)
         except Exception as e:
             print('/'.join(f_path) + ':' + e.__str__())
             return
 
         try:
-            CheckInput(self.sys.CtDir, Encode(t_path[-1]))
+            CheckWritable(TargetFather)
+            CheckInput(TargetFather, name_bin)
         except Exception as e:
             print(t_path[-1] + ':' + e.__str__())
             return
 
+        self.sys.SetDirty()
         if obj_type == 'file':
-            # 创建文件
-            TargetFather.son.append(File(name_bin, TargetFather.path + b'/' + name_bin))
+            # 创建文件，开启了压缩时新建的文件为压缩文件
+            Target = File(name_bin, TargetFather.path + b'/' + name_bin)
+            if self.sys.Compress:
+                Target.Frames = []
+            TargetFather.AddSon(Target)
         elif obj_type == 'dir':
             # 创建目录
-            TargetFather.son.append(Dir(name_bin, TargetFather.path + b'/' + name_bin, TargetFather))
+            TargetFather.AddSon(Dir(name_bin, TargetFather.path + b'/' + name_bin, TargetFather))
 
+    @journaled(lambda self, path: [self.AbsPath(path)], exclusive=True)
     def rm(self, path: str) -> str:
         """删除某个文件或目录"""
         try:
             TargetFather, Target = GetTarget(self.sys, path)
+            CheckWritable(Target)
         except Exception as e:
             return path + e.__str__()
 
         return remove(self.sys, TargetFather, Target)
 
+    @read_locked
     def ls(self, path: str = None) -> None:
         """查看目录下文件和目录"""
         # 查看当前目录
@@ -77,66 +144,89 @@ class Command:
 
         if Target.type == b'file':
             print(path + ':' + '是一个文件')
+            return
 
-        print('-权限-  --名称--  -----最近修改时间-----  --大小--')
-        for obj in Target.son:
+        print('-权限-  --名称--  -----最近修改时间-----  --大小--  --占用--')
+        for obj in Target.son.values():
             # 目录，直接输出
             if obj.type == b'dir':
                 print('d---    ' + FillStr(Decode(obj.name), 8, ' ', 0))
 
-        for obj in Target.son:
-            # 文件，输出权限 + 名称 + 最后修改时间
+        for obj in Target.son.values():
+            # 文件，输出权限 + 名称 + 最后修改时间 + 大小 + 占用的盘块大小（压缩文件以z标记，内嵌文件以i标记）
             if obj.type == b'file':
+                with obj.Lock.Read():
+                    OnDisk = len(self.sys.FindBlocks(obj)) * BLOCK_SIZE
                 print('-' + FillStr(File.FilePower[obj.power], 7, ' ')
                       + FillStr(Decode(obj.name), 8, ' ', 0)
                       + FillStr(Decode(obj.LastTime), 23, ' ', 0)
                       + FillStr(str(obj.size), 10, ' ', 0)
-                      + 'B')
+                      + 'B'
+                      + FillStr(str(OnDisk), 9, ' ', 0)
+                      + 'B' + (' z' if obj.Frames is not None else '') + (' i' if obj.Inline is not None else ''))
+
+    def rmdir(self, path: str, confirm: bool = True, quiet: bool = False) -> str:
+        """递归删除当前目录的一个子目录，confirm为False时不需要确认，quiet为True时删除成功不输出信息"""
+
+        if confirm:
+            print(f'这个操作将删除目录 {path} 以及此目录下的所有文件和目录，是否继续？\n'
+                  'y or Y -> 继续；其他 -> 退出', end=':')
+            flag = input()
+            if flag.lower() != 'y':
+                return '退出删除操作'
 
-    def rmdir(self, path: str) -> str:
-        """递归删除当前目录的一个子目录"""
+        return self.RemoveDir(path, quiet)
 
-        print(f'这个操作将删除目录 {path} 以及此目录下的所有文件和目录，是否继续？\n'
-              'y or Y -> 继续；其他 -> 退出', end=':')
-        flag = input()
-        if flag.lower() != 'y':
-            return '退出删除操作'
+    @journaled(lambda self, path, quiet=False: [self.AbsPath(path)], exclusive=True)
+    def RemoveDir(self, path: str, quiet: bool = False) -> str:
+        """
+        递归删除目录，quiet为True时删除成功不输出信息
 
+        一次遍历收集目录树中所有的文件和目录，批量释放所有文件的盘块，再把整棵树从父目录中移除
+        """
         # 找到要递归删除的目录
         try:
-            TargetFather, Target = GetTarget(self.sys, path)
+            _, Target = GetTarget(self.sys, path)
         except Exception as e:
             return path + ':' + e.__str__()
 
         if Target.type == b'file':
             return path + ':' + '是一个文件'
-
-        print(' '.join(['删除' + path + '开始']), end='\n\n')
-        # 采用压栈出栈的方式遍历全部子目录和子目录中的文件
-        # 后序遍历，即 子节点1 -> 子节点2 -> ... -> 子节点n -> 根节点
+        # 路径以 '..' 结尾时解析得到的父目录不是目标真正的父目录，只能由目标本身判断
+        if Target is self.sys.RootDir or Target.father is None:
+            return path + ':' + '不能删除根目录'
+        if Target.path.startswith(SNAP_PREFIX):
+            return path + ':' + '快照是只读的'
+        if Target.father.son.get(Target.name) is not Target:
+            return path + ':' + '没有那个文件或目录'
+
+        # 先序遍历，目录按 父目录 -> 子目录 的顺序排列
+        Files, Dirs = [], []
         stack = [Target]
         while len(stack) > 0:
-            trans_root = stack[len(stack) - 1]
-
-            # 取出了所有子目录和子文件，出栈
-            if len(trans_root.son) == 0:
-                print(remove(self.sys, trans_root.father, trans_root))
-                stack.remove(trans_root)
-                continue
-
-            # 对子目录的子文件/目录
-            for obj in trans_root.son:
-                # 文件，删除
+            trans_root = stack.pop()
+            Dirs.append(trans_root)
+            for obj in trans_root.son.values():
                 if obj.type == b'file':
-                    print(remove(self.sys, trans_root, obj))
-                # 目录，压栈
+                    Files.append(obj)
                 else:
                     stack.append(obj)
-                    break
 
-        self.sys.CtDir = TargetFather
+        # 检查都通过后再释放盘块
+        self.sys.DeleteMany(Files)
+        self.sys.PathCache.InvalidateTree(Target.path)
+        Target.father.DelSon(Target)
+        self.sys.SetDirty()
+        self.sys.CtDir = Target.father
+
+        if quiet:
+            return ''
+        # 按 文件 -> 子目录 -> 父目录 的顺序输出，一次输出全部信息
+        print('删除' + path + '开始', end='\n\n')
+        print('\n'.join(['删除' + Decode(obj.name) + '成功' for obj in Files + Dirs[::-1]]))
         return '\n' + ' '.join(['删除', path, '完成'])
 
+    @read_locked
     def cd(self, path: str = None) -> None:
         """进入某个目录"""
         # 为空，进入根目录
@@ -162,6 +252,9 @@ class Command:
 
         self.sys.CtDir = Target
 
+    @journaled(lambda self, param_list: [param_list[:2] + [self.AbsPath(param_list[2])]]
+               if len(param_list) == 3 and param_list[1] in ('>', '>>') else None,
+               target=lambda Args: Args[0][2])
     def cat(self, param_list: list):
         """查看/覆盖/追加 文件内容"""
         # 覆盖或追加
@@ -181,29 +274,274 @@ class Command:
         # 查看文件内容
         elif len(param_list) == 1:
             try:
-                print(cat(self.sys, 'read', param_list[0]))
+                cat(self.sys, 'read', param_list[0])
             except Exception as e:
                 print(param_list[0] + ':' + e.__str__())
         else:
             print('非法输入')
 
+    @read_locked
+    def read(self, path: str, offset: int, length: int) -> None:
+        """从文件的offset处读取length个字节并输出"""
+        try:
+            Target = GetFile(self.sys, path)
+        except Exception as e:
+            print(path + ':' + e.__str__())
+            return
+
+        with Target.Lock.Read():
+            Data = self.sys.ReadAt(Target, offset, length)
+        print(Data.decode('utf-8', 'replace'))
+
+    @journaled(lambda self, path, offset, data: [self.AbsPath(path), offset, data])
+    def write(self, path: str, offset: int, data: str) -> None:
+        """从文件的offset处开始覆盖写入data"""
+        try:
+            Target = GetFile(self.sys, path)
+            CheckWritable(Target)
+        except Exception as e:
+            print(path + ':' + e.__str__())
+            return
+
+        if not self.sys.WriteAt(Target, offset, Encode(data)):
+            print(path + ':' + '磁盘空间不足')
+
+    @journaled(lambda self, src, dst: [self.AbsPath(src), self.AbsPath(dst)], exclusive=True)
+    def cp(self, src: str, dst: str) -> None:
+        """
+        将src复制为dst，dst是已存在的目录时复制到此目录下
+
+        复制的文件与原文件共用盘块，不复制数据，之后修改其中一个时再复制被修改的盘块
+        """
+        try:
+            _, Source = GetTarget(self.sys, src)
+        except Exception as e:
+            print(src + ':' + e.__str__())
+            return
+
+        StartDir, f_path, t_path = AnalysisPath(self.sys, dst)
+        try:
+            _, Target = ResolvePath(self.sys, StartDir, t_path)
+        except Exception:
+            Target = None
+
+        if Target is not None and Target.type == b'dir':
+            # 复制到已存在的目录下，名称不变
+            TargetFather, name_bin = Target, Source.name
+        else:
+            try:
+                _, TargetFather = ResolvePath(self.sys, StartDir, f_path)
+            except Exception as e:
+                print('/'.join(f_path) + ':' + e.__str__())
+                return
+            name_bin = Encode(t_path[-1])
+
+        try:
+            if TargetFather.type == b'file':
+                raise Exception('是一个文件')
+            CheckWritable(TargetFather)
+            CheckInput(TargetFather, name_bin)
+        except Exception as e:
+            print(dst + ':' + e.__str__())
+            return
+
+        # 先复制出整棵树再挂到目标目录下，复制到自身的子目录中时不会重复复制
+        TargetFather.AddSon(clone(self.sys, Source, name_bin, TargetFather))
+        self.sys.SetDirty()
+
     def disk(self) -> None:
-        """查看存储空间使用情况"""
+        """查看存储空间使用情况，以及文件的逻辑占用和实际占用"""
         used, remain = self.sys.Disk()
         print(f'空间使用了{str(used * 100)}%，剩余{remain}KB')
 
+        Size, Logical, Physical = self.sys.Usage()
+        print(f'文件大小共{Size}B，实际占用{Physical * BLOCK_SIZE}B'
+              + (f'，为文件大小的{Physical * BLOCK_SIZE / Size:.2%}' if Size else ''))
+        print(f'文件逻辑占用{Logical}个盘块，实际占用{Physical}个盘块'
+              + (f'，共用盘块节省了{Logical / Physical:.2f}倍' if Physical else ''))
+
+    @journaled(lambda self, op=None, path=None: None if op is None else [op] if path is None
+               else [op, self.AbsPath(path)], exclusive=True)
+    def compress(self, op: str = None, path: str = None) -> None:
+        """
+        指定path时将文件转换为压缩文件（op为on）或不压缩的文件（op为off）\n
+        不指定path时设置新建的文件是否压缩，op也为None时查看压缩状态
+        """
+        if path is None:
+            if op is not None:
+                self.sys.Compress = op == 'on'
+                self.sys.SetDirty()
+            print('新建的文件' + ('压缩' if self.sys.Compress else '不压缩'))
+            return
 
-def CheckInput(tg_dir: Dir, name_bin: bytes) -> str:
+        try:
+            Target = GetFile(self.sys, path)
+            CheckWritable(Target)
+        except Exception as e:
+            print(path + ':' + e.__str__())
+            return
+
+        if (Target.Frames is not None) == (op == 'on'):
+            return
+        # 读出内容后以新的方式重新写入
+        Data = b''.join(self.sys.ReadFile(Target))
+        Frames, Target.Frames = Target.Frames, [] if op == 'on' else None
+        if not self.sys.WriteFile(Target, Data):
+            Target.Frames = Frames
+            print(path + ':' + '磁盘空间不足')
+            return
+        self.sys.SetDirty()
+
+    @journaled(lambda self, op=None: None if op is None else [op], exclusive=True)
+    def dedup(self, op: str = None) -> None:
+        """op为on/off时开启/关闭写入时去重，否则查看去重状态"""
+        if op == 'on' or op == 'off':
+            self.sys.Dedup.Enabled = op == 'on'
+            self.sys.SetDirty()
+        print('写入时去重已' + ('开启' if self.sys.Dedup.Enabled else '关闭')
+              + f'，索引中有{len(self.sys.Dedup.Keys)}个盘块')
+
+    def stats(self, op: str = None) -> None:
+        """查看性能统计，op为on/off时开启/关闭统计，reset时清空，json时以JSON格式输出"""
+        if op == 'on' or op == 'off':
+            metrics.Enable(op == 'on')
+            print('性能统计已' + ('开启' if op == 'on' else '关闭'))
+            return
+        if op == 'reset':
+            metrics.REGISTRY.Reset()
+            print('性能统计已清空')
+            return
+        if op == 'json':
+            print(json.dumps(metrics.Dump(), ensure_ascii=False))
+            return
+
+        Dump = metrics.Dump()
+        if not Dump['enabled']:
+            print('性能统计未开启，输入 stats on 开启')
+        print('--------计数器--------  ----次数----')
+        for Name, Value in Dump['counters'].items():
+            print(FillStr(Name, 22, ' ') + FillStr(str(Value), 14, ' ', 0))
+        print('--------直方图--------  ----次数----  --平均(us)--  ---p50(us)--  ---p99(us)--  ---最长(us)--')
+        for Name, Hist in Dump['histograms'].items():
+            print(FillStr(Name, 22, ' ')
+                  + ''.join(FillStr(str(Hist[Key]), 14, ' ', 0)
+                            for Key in ('count', 'mean_us', 'p50_us', 'p99_us', 'max_us')))
+
+    def prof(self, op: str = None, arg=None) -> None:
+        """
+        分析命令的性能\n
+        op为next时分析接下来的arg条命令，slow时分析用时超过arg毫秒的命令，off时停止分析，
+        reset时清空结果，dump时将结果写入本地文件arg，为None时输出分析结果
+        """
+        if op == 'next':
+            PROFILER.Next(arg)
+            print(f'将分析接下来的{arg}条命令')
+        elif op == 'slow':
+            PROFILER.Slow(arg / 1000)
+            print(f'将分析用时超过{arg:g}ms的命令')
+        elif op == 'off':
+            PROFILER.Off()
+            print('性能分析已关闭')
+        elif op == 'reset':
+            PROFILER.Reset()
+            print('性能分析结果已清空')
+        elif op == 'dump':
+            if PROFILER.Dump(arg):
+                print('性能分析结果已写入' + arg)
+            else:
+                print('还没有分析结果')
+        else:
+            PROFILER.Report()
+
+    def defrag(self, op: str = None, time_slice: float = 10) -> None:
+        """
+        op为None时输出文件和空闲空间的碎片情况\n
+        op为run时整理碎片，每次最多运行time_slice毫秒后暂停，让其他操作可以执行
+        """
+        if op == 'run':
+            Moved, Slices = defrag(self.sys, time_slice / 1000)
+            print(f'整理了{Moved}个文件，共{Slices}个时间片')
+
+        with VolumeLock.Read():
+            Report = self.sys.Fragmentation(AllFiles(self.sys.RootDir))
+        print(f'文件数：{Report["files"]}，其中不连续的文件：{Report["fragmented_files"]}')
+        print(f'区段数：{Report["extents"]}，平均每个文件{Report["extents_per_file"]}个，最多{Report["max_extents"]}个')
+        print(f'空闲盘块：{Report["free_blocks"]}，分为{Report["free_runs"]}段，'
+              f'最长的一段{Report["largest_free_run"]}个盘块')
+
+    @journaled(lambda self, op=None, name=None: [op, name] if op in ('create', 'rollback', 'delete') else None,
+               exclusive=True)
+    def snap(self, op: str = None, name: str = None) -> None:
+        """
+        op为None时列出所有快照\n
+        create -> 创建整个目录树的快照，快照中的文件与原文件共用盘块\n
+        mount -> 进入快照的根目录，快照是只读的，输入 cd 回到根目录\n
+        rollback -> 将目录树回滚到快照时的状态，快照保留\n
+        delete -> 删除快照，释放只有快照在使用的盘块
+        """
+        Snapshots = self.sys.Snapshots
+        if op is None:
+            if not Snapshots:
+                print('还没有快照')
+            for Root in Snapshots.values():
+                Files = AllFiles(Root)
+                print(FillStr(Decode(Root.name), 8, ' ', 0) + FillStr(Decode(Root.CreateTime), 23, ' ', 0)
+                      + FillStr(str(len(Files)), 6, ' ', 0) + '个文件  '
+                      + f'独占{self.sys.Exclusive(Files)}个盘块')
+            return
+
+        name_bin = Encode(name)
+        if op == 'create':
+            if len(name_bin) > NAME_SIZE_LIMIT or name_bin in Snapshots:
+                print(name + ':' + ('快照名过长' if len(name_bin) > NAME_SIZE_LIMIT else '存在同名快照'))
+                return
+            Snapshots[name_bin] = CloneRoot(self.sys, self.sys.RootDir, name_bin, SNAP_PREFIX + name_bin)
+            self.sys.SetDirty()
+            print('创建快照' + name + '成功')
+            return
+
+        Root = Snapshots.get(name_bin)
+        if Root is None:
+            print(name + ':' + '没有那个快照')
+        elif op == 'mount':
+            self.sys.CtDir = Root
+        elif op == 'rollback':
+            # 先复制快照再释放原来的文件，快照中的盘块一直被快照引用，不会被释放
+            Files = AllFiles(self.sys.RootDir)
+            self.sys.RootDir = CloneRoot(self.sys, Root, self.sys.RootDir.name, b'')
+            self.sys.DeleteMany(Files)
+            self.sys.PathCache.InvalidateTree(b'')
+            self.sys.DefaultDir = self.sys.CtDir = self.sys.RootDir
+            self.sys.SetDirty()
+            print('回滚到快照' + name + '成功')
+        elif op == 'delete':
+            self.sys.DeleteMany(AllFiles(Root))
+            self.sys.PathCache.InvalidateTree(Root.path)
+            del Snapshots[name_bin]
+            self.sys.SetDirty()
+            print('删除快照' + name + '成功')
+
+    def AbsPath(self, path: str) -> str:
+        """将相对当前目录的路径转换为绝对路径"""
+        if path.startswith('/'):
+            return path
+        return Decode(self.sys.CtDir.path) + '/' + path
+
+
+def CheckInput(tg_dir: Dir, name_bin: bytes) -> None:
     """检查输入合法性 以及 是否有重名对象"""
     # 检查输入合法性
     if len(name_bin) > NAME_SIZE_LIMIT:
         raise Exception('文件名过长')
     # 检查在同一目录是否有同名子节点
-    try:
-        tg_dir.FindSon(name_bin)
-    except Exception as e:
-        return e.__str__()
-    raise Exception('存在同名目录/文件')
+    if name_bin in tg_dir.son:
+        raise Exception('存在同名目录/文件')
+
+
+def CheckWritable(obj: Dir | File) -> None:
+    """快照中的目录/文件是只读的"""
+    if obj.path.startswith(SNAP_PREFIX):
+        raise Exception('快照是只读的')
 
 
 def SysInit():
@@ -240,6 +578,8 @@ def AnalysisPath(sys: FileSystem, path: str = None) -> (Dir, list, list):
 def GetObjFromPath(str_dir: Dir, path: list) -> (Dir | File):
     """根据起始目录和输入路径找到目标目录/文件"""
     ViaObj = str_dir
+    if metrics.ENABLED:
+        metrics.Count('path.components', len(path))
 
     # 逐层深入
     for ViaDirName in path:
@@ -254,54 +594,201 @@ def GetObjFromPath(str_dir: Dir, path: list) -> (Dir | File):
     return ViaObj
 
 
+def ResolvePath(sys: FileSystem, str_dir: Dir, path: list) -> (Dir, Dir | File):
+    """
+    根据起始目录和输入路径找到目标的父目录和目标
+
+    先在路径解析缓存中查找，没有记录时由父目录的解析结果再走一层，并记录下来；
+    起始目录已不在目录树中时不使用缓存
+    """
+    if len(path) == 0:
+        return str_dir.father, str_dir
+
+    # 含有 '..' 或空名字的路径不记录；起始目录已被删除时，以其路径为键的记录会指向已删除的目录树，也不记录
+    Cacheable = '..' not in path and '' not in path and (str_dir is sys.RootDir or Mounted(sys, str_dir))
+    Key = str_dir.path + Encode('/' + '/'.join(path))
+    if Cacheable:
+        Entry = sys.PathCache.Get(Key)
+        if metrics.ENABLED:
+            metrics.Count('path.cache_hits' if Entry is not None else 'path.cache_misses')
+        if Entry is not None:
+            return Entry
+
+    _, TargetFather = ResolvePath(sys, str_dir, path[:-1])
+    Target = GetObjFromPath(TargetFather, path[-1:])
+
+    if Cacheable:
+        sys.PathCache.Put(Key, (TargetFather, Target))
+    return TargetFather, Target
+
+
 def GetTarget(sys: FileSystem, path: str) -> (Dir, Dir | File):
     """从输入的路径判断目标路径"""
-    StartDir, f_path, t_path = AnalysisPath(sys, path)
-    TargetFather = GetObjFromPath(StartDir, f_path)
-    Target = GetObjFromPath(StartDir, t_path)
+    StartDir, _, t_path = AnalysisPath(sys, path)
 
-    return TargetFather, Target
+    return ResolvePath(sys, StartDir, t_path)
 
 
-def cat(sys: FileSystem, *args: str) -> str:
-    """cat每种逻辑的操作"""
-    # 找到文件
-    _, Target = GetTarget(sys, args[1])
+@contextmanager
+def LockFile(sys: FileSystem, path: str):
+    """持有卷的读锁以及path指向文件的写锁，path不存在或是目录时只持有卷的读锁（命令自己会报错）"""
+    if not isinstance(path, str):
+        raise TypeError('要加锁的路径应为字符串')
+    with VolumeLock.Read():
+        try:
+            _, Target = GetTarget(sys, path)
+        except Exception:
+            Target = None
+        with Target.Lock.Write() if Target is not None and Target.type == b'file' else nullcontext():
+            yield
+
+
+def GetFile(sys: FileSystem, path: str) -> File:
+    """从输入的路径找到目标文件，目标是目录时报错"""
+    _, Target = GetTarget(sys, path)
 
     if Target.type == b'dir':
         raise Exception('是一个目录')
 
+    return Target
+
+
+def AllFiles(root: Dir) -> list:
+    """返回目录树中所有的文件"""
+    Files = []
+    stack = [root]
+    while len(stack) > 0:
+        for obj in stack.pop().son.values():
+            if obj.type == b'file':
+                Files.append(obj)
+            else:
+                stack.append(obj)
+    return Files
+
+
+def defrag(sys: FileSystem, time_slice: float, pause: float = 0.001) -> (int, int):
+    """
+    整理碎片，将不连续的文件依次移动到连续的盘块中，返回 (移动的文件数, 时间片数)
+
+    每个文件在持有卷的读锁和该文件的写锁时移动，每个时间片最多运行time_slice秒，
+    之后释放所有锁并暂停pause秒，期间其他操作可以正常执行
+    """
+    with VolumeLock.Read():
+        Files = AllFiles(sys.RootDir)
+
+    Moved, Slices = 0, 0
+    Index = 0
+    while Index < len(Files):
+        Slices += 1
+        Start = perf_counter()
+        with VolumeLock.Read():
+            # 每个时间片至少处理一个文件
+            while Index < len(Files):
+                Target = Files[Index]
+                Index += 1
+                if Attached(sys, Target):
+                    with Target.Lock.Write():
+                        Moved += sys.Relocate(Target)
+                if perf_counter() - Start >= time_slice:
+                    break
+        sleep(pause)
+    return Moved, Slices
+
+
+def Attached(sys: FileSystem, target: File) -> bool:
+    """文件是否仍在目录树中（可能已被删除）"""
+    try:
+        return GetTarget(sys, Decode(target.path))[1] is target
+    except Exception:
+        return False
+
+
+def cat(sys: FileSystem, *args: str) -> None:
+    """cat每种逻辑的操作，查看时逐块输出文件内容"""
+    # 找到文件
+    Target = GetFile(sys, args[1])
+
     if args[0] == 'read':
-        # 查看
-        return Decode(sys.Read(Target.address))
+        # 查看，逐块解码后输出，多字节字符可能跨越两个盘块，需要增量解码
+        Decoder = getincrementaldecoder('utf-8')()
+        with Target.Lock.Read():
+            for Chunk in sys.ReadFile(Target):
+                print(Decoder.decode(Chunk), end='')
+        print(Decoder.decode(b'', final=True))
     elif args[0] == 'cover':
         # 覆盖
-        sys.Delete(Target.address)
-        Target.Write(sys.Write(Encode(args[2])), len(Encode(args[2])))
+        CheckWritable(Target)
+        sys.SetDirty()
+        if not sys.WriteFile(Target, Encode(args[2])):
+            raise Exception('磁盘空间不足')
     elif args[0] == 'add':
-        # 追加
-        str_old = sys.Read(Target.address)
-        sys.Delete(Target.address)
-        Target.Write(sys.Write(str_old + Encode(args[2])), len(str_old + Encode(args[2])))
+        # 追加，只写入新增的内容
+        CheckWritable(Target)
+        if not sys.Append(Target, Encode(args[2])):
+            raise Exception('磁盘空间不足')
     else:
         raise Exception('系统错误！')
 
 
 def remove(sys: FileSystem, target_father: Dir, target: Dir | File):
-    """删除指定目录下的指定文件/目录"""
+    """删除指定目录下的指定文件/目录，删除的是当前目录时回到其父目录"""
     # 文件
     if target.type == b'file':
         # 删除存储信息
-        sys.Delete(target.address)
+        sys.DeleteMany([target])
     # 目录，且不为空
     elif len(target.son) != 0:
         return '目录不为空，尝试使用命令 rmdir ' + Decode(target.name)
+    # 路径以 '..' 结尾时解析得到的父目录不是目录真正的父目录，由目录本身找到父目录
+    elif target.father is None:
+        return '不能删除根目录'
+    else:
+        target_father = target.father
+        if sys.CtDir is target:
+            sys.CtDir = target_father
 
     target_father.DelSon(target)
+    sys.SetDirty()
+    sys.PathCache.Invalidate(target.path)
 
     return ' '.join(['删除' + Decode(target.name) + '成功'])
 
 
+def clone(sys: FileSystem, source: Dir | File, name_bin: bytes, father: Dir) -> Dir | File:
+    """复制文件或目录树，命名为name_bin，父目录为father，复制的文件共用原文件的盘块"""
+    path = father.path + b'/' + name_bin
+    if source.type == b'file':
+        Copy = File(name_bin, path)
+        sys.Share(source)
+        Copy.address, Copy.size = source.address, source.size
+        Copy.Frames = None if source.Frames is None else list(source.Frames)
+        Copy.Inline = source.Inline
+        Copy.power, Copy.LastTime = source.power, source.LastTime
+        return Copy
+
+    Copy = Dir(name_bin, path, father)
+    for obj in list(source.son.values()):
+        Copy.AddSon(clone(sys, obj, obj.name, Copy))
+    return Copy
+
+
+def CloneRoot(sys: FileSystem, source: Dir, name_bin: bytes, path: bytes) -> Dir:
+    """复制整棵目录树，新的根目录命名为name_bin、路径为path，复制的文件共用原文件的盘块"""
+    Root = Dir(name_bin, path, None)
+    for obj in list(source.son.values()):
+        Root.AddSon(clone(sys, obj, obj.name, Root))
+    return Root
+
+
+def Mounted(sys: FileSystem, directory: Dir) -> bool:
+    """目录是否仍在目录树或某个快照中（可能已被删除或回滚）"""
+    while directory.father is not None:
+        if directory.father.son.get(directory.name) is not directory:
+            return False
+        directory = directory.father
+    return directory is sys.RootDir or sys.Snapshots.get(directory.name) is directory
+
+
 def SpiltLine():
     print('---------------------------------')
 
@@ -0,0 +1,132 @@
+from __future__ import annotations
+from threading import Thread, Lock, Condition
+import struct
+import json
+import zlib
+import os
+
+
+# 每条记录：记录头(数据长度, CRC32) + 数据(JSON：[序号, 操作, 参数])
+RECORD_HEAD = struct.Struct('<II')
+
+
+class Journal:
+    """
+    操作日志（预写式日志），记录每一次修改文件系统的操作，启动时在镜像文件的基础上重做，包括
+
+    属性：
+        path(str) -> 日志文件路径\n
+        Seq(int) -> 最后一条记录的序号\n
+        DurableSeq(int) -> 已经写入磁盘的最后一条记录的序号\n
+        Deferred(bool) -> 为True时操作追加记录后不等待写入磁盘，批量执行时使用\n
+
+    方法：
+        Append -> 追加一条记录，返回记录的序号\n
+        Wait -> 等待记录写入磁盘\n
+        Checkpoint -> 删除已经保存在镜像文件中的记录\n
+        Close -> 写入剩余的记录并关闭日志文件
+
+    记录由后台线程成组写入：写入磁盘期间新追加的记录会在下一次一起写入并只调用一次fsync
+    """
+
+    def __init__(self, path: str, seq: int = 0):
+        self.path = path
+        self.Seq = seq
+        self.DurableSeq = seq
+        self.Deferred = False  # 追加记录后是否不等待写入磁盘
+        self.Pending = []  # 等待写入的 (序号, 数据)
+        self.Written = []  # 已写入但还未保存到镜像文件的 (序号, 数据)
+        self.Cond = Condition()
+        self.IOLock = Lock()
+        self.Closed = False
+        # 删除末尾不完整或损坏的记录，否则之后追加的记录都排在它后面，重做时读不到
+        _, End = ScanJournal(path)
+        if os.path.exists(path) and os.path.getsize(path) > End:
+            with open(path, 'r+b') as f:
+                f.truncate(End)
+                f.flush()
+                os.fsync(f.fileno())
+        self.File = open(path, 'ab')
+        self.Flusher = Thread(target=self.Flush, daemon=True)
+        self.Flusher.start()
+
+    def Append(self, op: str, args: list) -> int:
+        """追加一条记录，返回记录的序号"""
+        with self.Cond:
+            self.Seq += 1
+            Data = json.dumps([self.Seq, op, args], ensure_ascii=False).encode('utf-8')
+            self.Pending.append((self.Seq, RECORD_HEAD.pack(len(Data), zlib.crc32(Data)) + Data))
+            self.Cond.notify_all()
+            return self.Seq
+
+    def Wait(self, seq: int) -> None:
+        """等待序号不大于seq的记录全部写入磁盘"""
+        with self.Cond:
+            while self.DurableSeq < seq and not self.Closed:
+                self.Cond.wait()
+
+    def Flush(self) -> None:
+        """后台线程，成组写入等待中的记录"""
+        while True:
+            with self.Cond:
+                while len(self.Pending) == 0 and not self.Closed:
+                    self.Cond.wait()
+                if len(self.Pending) == 0:
+                    return
+                Batch, self.Pending = self.Pending, []
+
+            with self.IOLock:
+                self.File.write(b''.join([Data for _, Data in Batch]))
+                self.File.flush()
+                os.fsync(self.File.fileno())
+                self.Written.extend(Batch)
+
+            with self.Cond:
+                self.DurableSeq = Batch[-1][0]
+                self.Cond.notify_all()
+
+    def Checkpoint(self, seq: int) -> None:
+        """镜像文件已经包含序号不大于seq的记录，将它们从日志文件中删除"""
+        with self.IOLock:
+            self.Written = [(Seq, Data) for Seq, Data in self.Written if Seq > seq]
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(b''.join([Data for _, Data in self.Written]))
+                f.flush()
+                os.fsync(f.fileno())
+            self.File.close()
+            os.replace(self.path + '.tmp', self.path)
+            self.File = open(self.path, 'ab')
+
+    def Close(self) -> None:
+        """写入剩余的记录并关闭日志文件"""
+        with self.Cond:
+            self.Closed = True
+            self.Cond.notify_all()
+        self.Flusher.join()
+        self.File.close()
+
+
+def ReadJournal(path: str) -> list:
+    """读取日志文件中的所有记录 [序号, 操作, 参数]，读到不完整或损坏的记录时停止"""
+    return ScanJournal(path)[0]
+
+
+def ScanJournal(path: str) -> (list, int):
+    """返回日志文件中所有完整的记录，以及最后一条完整记录的结束位置"""
+    try:
+        with open(path, 'rb') as f:
+            Content = f.read()
+    except FileNotFoundError:
+        return [], 0
+
+    Records = []
+    Offset = 0
+    while Offset + RECORD_HEAD.size <= len(Content):
+        Length, Crc = RECORD_HEAD.unpack_from(Content, Offset)
+        Data = Content[Offset + RECORD_HEAD.size: Offset + RECORD_HEAD.size + Length]
+        if len(Data) != Length or zlib.crc32(Data) != Crc:
+            break
+        Records.append(json.loads(Data.decode('utf-8')))
+        Offset += RECORD_HEAD.size + Length
+
+    return Records, Offset
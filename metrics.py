@@ -0,0 +1,137 @@
+"""
+性能统计\n
+记录各种操作的次数（计数器）和用时（直方图），默认关闭，设置环境变量 FSSIM_METRICS=1 或输入 stats on 开启\n
+调用处先判断 metrics.ENABLED 再记录，关闭时只多一次判断
+"""
+from functools import wraps
+from time import perf_counter
+import threading
+import os
+
+ENABLED = os.environ.get('FSSIM_METRICS', '') not in ('', '0')
+BUCKET_AMT = 32  # 直方图的桶数，第i个桶记录用时在 [2^(i-1), 2^i) 微秒内的操作
+
+
+class Histogram:
+    """
+    用时直方图，按2的幂次分桶，包括方法：
+        Observe -> 记录一次用时\n
+        Percentile -> 用时的百分位数（所在桶的上界）\n
+        Dump -> 转换为字典
+    """
+
+    def __init__(self):
+        self.Buckets = [0] * BUCKET_AMT
+        self.Count = 0
+        self.Total = 0.0  # 总用时（秒）
+        self.Max = 0.0  # 最长用时（秒）
+
+    def Observe(self, seconds: float) -> None:
+        """记录一次用时"""
+        self.Buckets[min(BUCKET_AMT - 1, int(seconds * 1e6).bit_length())] += 1
+        self.Count += 1
+        self.Total += seconds
+        if seconds > self.Max:
+            self.Max = seconds
+
+    def Percentile(self, percent: float) -> float:
+        """用时的百分位数（微秒），取所在桶的上界"""
+        Rank = self.Count * percent / 100
+        Seen = 0
+        for Index, Amount in enumerate(self.Buckets):
+            Seen += Amount
+            if Seen >= Rank and Amount:
+                return round(min(float(1 << Index), self.Max * 1e6), 2)
+        return 0.0
+
+    def Dump(self) -> dict:
+        return {
+            'count': self.Count,
+            'total_ms': round(self.Total * 1e3, 3),
+            'mean_us': round(self.Total / self.Count * 1e6, 2) if self.Count else 0.0,
+            'p50_us': self.Percentile(50),
+            'p99_us': self.Percentile(99),
+            'max_us': round(self.Max * 1e6, 2),
+            'buckets': {1 << Index: Amount for Index, Amount in enumerate(self.Buckets) if Amount},
+        }
+
+
+class Registry:
+    """
+    统计项的注册表，包括方法：
+        Count -> 增加计数器\n
+        Observe -> 记录一次用时\n
+        Dump -> 转换为字典\n
+        Reset -> 清空所有统计项
+    """
+
+    def __init__(self):
+        self.Counters = {}  # 名称 -> 次数
+        self.Histograms = {}  # 名称 -> 用时直方图
+        self.Lock = threading.Lock()
+
+    def Count(self, name: str, amount: int = 1) -> None:
+        with self.Lock:
+            self.Counters[name] = self.Counters.get(name, 0) + amount
+
+    def Observe(self, name: str, seconds: float) -> None:
+        with self.Lock:
+            Hist = self.Histograms.get(name)
+            if Hist is None:
+                Hist = self.Histograms[name] = Histogram()
+            Hist.Observe(seconds)
+
+    def Dump(self) -> dict:
+        with self.Lock:
+            return {
+                'enabled': ENABLED,
+                'counters': dict(sorted(self.Counters.items())),
+                'histograms': {Name: Hist.Dump() for Name, Hist in sorted(self.Histograms.items())},
+            }
+
+    def Reset(self) -> None:
+        with self.Lock:
+            self.Counters.clear()
+            self.Histograms.clear()
+
+
+REGISTRY = Registry()
+
+
+def Enable(flag: bool = True) -> None:
+    """开启或关闭统计"""
+    global ENABLED
+    ENABLED = flag
+
+
+def Count(name: str, amount: int = 1) -> None:
+    """计数器name增加amount"""
+    REGISTRY.Count(name, amount)
+
+
+def Observe(name: str, seconds: float) -> None:
+    """直方图name记录一次用时"""
+    REGISTRY.Observe(name, seconds)
+
+
+def Dump() -> dict:
+    """所有统计项，可直接转换为JSON"""
+    return REGISTRY.Dump()
+
+
+def timed(name: str):
+    """将此装饰器应用到需要统计用时的函数上，开启统计时记录函数每次的用时"""
+    def decorator(func):
+        @wraps(func)  # 复制原函数元信息
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            Start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                REGISTRY.Observe(name, perf_counter() - Start)
+
+        return wrapper
+
+    return decorator
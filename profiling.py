@@ -0,0 +1,130 @@
+"""
+命令的性能分析\n
+用 cProfile 分析接下来的若干条命令，或用时超过阈值的每一条命令，汇总结果可以写入本地文件，
+之后用 python -m pstats 等工具查看
+"""
+from time import perf_counter
+import cProfile
+import pstats
+import threading
+import sys as _sys
+
+RECENT_AMT = 20  # 记录最近分析过的命令数
+
+
+class Profiler:
+    """
+    命令分析器，包括
+
+    属性：
+        Remaining(int) -> 还需分析的命令数\n
+        Threshold(float) -> 用时超过此阈值（秒）的命令计入结果，None表示不按用时分析\n
+        Stats(pstats.Stats) -> 汇总的分析结果，None表示还没有结果\n
+        Recent(list) -> 最近计入结果的 (命令, 用时)\n
+    方法：
+        Next -> 分析接下来的n条命令\n
+        Slow -> 分析用时超过阈值的命令\n
+        Off -> 停止分析\n
+        Armed -> 下一条命令是否需要分析\n
+        Run -> 执行一条命令，需要时进行分析\n
+        Dump -> 将汇总的结果写入本地文件\n
+        Report -> 输出分析状态和最耗时的函数\n
+        Reset -> 清空汇总的结果
+    """
+
+    def __init__(self):
+        self.Remaining = 0
+        self.Threshold = None
+        self.Stats = None
+        self.Recent = []
+        self.Lock = threading.Lock()
+        # 同一时间只能有一个cProfile在运行，分析期间命令依次执行
+        self.RunLock = threading.Lock()
+
+    def Next(self, n: int = 1) -> None:
+        """分析接下来的n条命令"""
+        with self.Lock:
+            self.Remaining = n
+
+    def Slow(self, threshold: float) -> None:
+        """分析每一条命令，用时超过threshold秒的计入结果"""
+        with self.Lock:
+            self.Threshold = threshold
+
+    def Off(self) -> None:
+        """停止分析，已汇总的结果保留"""
+        with self.Lock:
+            self.Remaining = 0
+            self.Threshold = None
+
+    def Armed(self) -> bool:
+        """下一条命令是否需要分析"""
+        return self.Remaining > 0 or self.Threshold is not None
+
+    def Run(self, name: str, func, *args):
+        """执行 func(*args)，需要时进行分析并计入结果，返回 func 的返回值"""
+        with self.Lock:
+            Keep = self.Remaining > 0
+            if Keep:
+                self.Remaining -= 1
+            elif self.Threshold is None:
+                Keep = None
+        if Keep is None:
+            return func(*args)
+
+        with self.RunLock:
+            Profile = cProfile.Profile()
+            Start = perf_counter()
+            try:
+                return Profile.runcall(func, *args)
+            finally:
+                Elapsed = perf_counter() - Start
+                Threshold = self.Threshold
+                if Keep or (Threshold is not None and Elapsed >= Threshold):
+                    self.Add(name, Profile, Elapsed)
+
+    def Add(self, name: str, profile: cProfile.Profile, elapsed: float) -> None:
+        """将一条命令的分析结果计入汇总"""
+        with self.Lock:
+            if self.Stats is None:
+                self.Stats = pstats.Stats(profile)
+            else:
+                self.Stats.add(profile)
+            self.Recent.append((name, elapsed))
+            del self.Recent[:-RECENT_AMT]
+
+    def Dump(self, path: str) -> bool:
+        """将汇总的结果写入本地文件，没有结果时返回False"""
+        with self.Lock:
+            if self.Stats is None:
+                return False
+            self.Stats.dump_stats(path)
+            return True
+
+    def Report(self, top: int = 15) -> None:
+        """输出分析状态、最近分析过的命令以及累计用时最长的top个函数"""
+        with self.Lock:
+            if self.Remaining > 0:
+                print(f'将分析接下来的{self.Remaining}条命令')
+            if self.Threshold is not None:
+                print(f'分析用时超过{self.Threshold * 1000:g}ms的命令')
+            if not self.Armed():
+                print('性能分析未开启')
+            if self.Stats is None:
+                print('还没有分析结果')
+                return
+
+            print('最近分析过的命令：')
+            for Name, Elapsed in self.Recent:
+                print(f'    {Elapsed * 1000:10.3f}ms  {Name}')
+            self.Stats.stream = _sys.stdout
+            self.Stats.sort_stats('cumulative').print_stats(top)
+
+    def Reset(self) -> None:
+        """清空汇总的结果"""
+        with self.Lock:
+            self.Stats = None
+            self.Recent = []
+
+
+PROFILER = Profiler()
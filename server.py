@@ -0,0 +1,168 @@
+"""
+多客户端服务器\n
+加载一个文件系统，通过Unix域套接字或本地TCP端口同时为多个客户端执行命令，每个连接是一个会话，有自己的当前目录\n
+协议：客户端每次发送一行命令，服务器返回命令的输出，以 END 结尾，之后一行为会话的当前目录
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import argparse
+import asyncio
+import threading
+import signal
+import sys as _sys
+
+from basic import FileSystem
+from core import Command, Mounted
+import FileSystem as Main
+
+END = b'\x04'  # 一条命令输出的结束符
+WORKER_AMT = 32  # 执行命令的线程数
+
+
+class SessionOutput:
+    """
+    会话的输出，替换 sys.stdout\n
+    线程在执行某个会话的命令时输出到该会话的缓冲区，否则输出到原来的 sys.stdout
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.Local = threading.local()
+
+    def write(self, s: str) -> int:
+        return getattr(self.Local, 'Buffer', self.stdout).write(s)
+
+    def flush(self) -> None:
+        getattr(self.Local, 'Buffer', self.stdout).flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stdout, name)
+
+
+class Session:
+    """
+    一个客户端连接，包括
+
+    属性：
+        CtDir(Dir) -> 会话的当前目录\n
+        Closed(bool) -> 是否已输入exit\n
+    方法：
+        Execute -> 执行一行命令并返回输出
+    """
+    def __init__(self, sys: FileSystem, output: SessionOutput):
+        self.sys = sys
+        self.cmd = Command(sys)
+        self.output = output
+        self.CtDir = sys.CtDir
+        self.Closed = False
+
+    def Execute(self, line: str) -> str:
+        """在当前线程中以本会话的当前目录执行一行命令，返回命令的输出"""
+        Local = self.sys.Session
+        # 当前目录已被其他会话删除或回滚时，回到根目录
+        if not Mounted(self.sys, self.CtDir):
+            self.CtDir = self.sys.RootDir
+        Local.CtDir = self.CtDir
+        self.output.Local.Buffer = Buffer = StringIO()
+        try:
+            InputList = line.split()
+            if len(InputList) == 0:
+                pass
+            elif InputList[0] not in self.cmd.command.keys():
+                print('没有找到命令，输入 h 查看帮助')
+            # 删除目录时无法在客户端确认，直接删除
+            elif Main.interactive(InputList, self.cmd, False):
+                print('Bye!')
+                self.Closed = True
+        except Exception as e:
+            print(e.__str__())
+        finally:
+            self.CtDir = Local.CtDir
+            del Local.CtDir
+            del self.output.Local.Buffer
+        return Buffer.getvalue()
+
+
+class Server:
+    """
+    多客户端服务器，连接由asyncio处理，命令在线程池中执行
+
+    方法：
+        Start -> 开始监听\n
+        Close -> 停止监听并等待线程池中的命令执行完
+    """
+    def __init__(self, sys: FileSystem, workers: int = WORKER_AMT):
+        self.sys = sys
+        self.Executor = ThreadPoolExecutor(workers)
+        self.output = None
+        self.server = None
+
+    async def Start(self, path: str = None, host: str = '127.0.0.1', port: int = 0) -> None:
+        """指定path时监听Unix域套接字，否则监听本地TCP端口，port为0时由系统分配"""
+        self.output = SessionOutput(_sys.stdout)
+        _sys.stdout = self.output
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.Handle, path)
+        else:
+            self.server = await asyncio.start_server(self.Handle, host, port)
+
+    def Address(self):
+        """监听的地址"""
+        return self.server.sockets[0].getsockname()
+
+    async def Close(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        self.Executor.shutdown()
+        _sys.stdout = self.output.stdout
+
+    async def Handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """处理一个客户端连接"""
+        Loop = asyncio.get_running_loop()
+        session = Session(self.sys, self.output)
+        try:
+            writer.write(END + session.CtDir.path + b'\n')
+            await writer.drain()
+            while not session.Closed:
+                Line = await reader.readline()
+                if not Line:
+                    break
+                Output = await Loop.run_in_executor(self.Executor, session.Execute,
+                                                    Line.decode('utf-8', 'replace'))
+                writer.write(Output.encode('utf-8') + END + session.CtDir.path + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def Serve(sys: FileSystem, path: str = None, host: str = '127.0.0.1', port: int = 0) -> None:
+    """运行服务器直到收到 Ctrl+c"""
+    server = Server(sys)
+    await server.Start(path, host, port)
+    print('正在监听', server.Address(), file=server.output.stdout)
+
+    Stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGINT, Stop.set)
+    await Stop.wait()
+    await server.Close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文件系统服务器')
+    parser.add_argument('--unix', help='监听的Unix域套接字路径')
+    parser.add_argument('--host', default='127.0.0.1', help='监听的地址')
+    parser.add_argument('--port', type=int, default=8421, help='监听的端口')
+    args = parser.parse_args()
+
+    sys_lch = Main.SysInitialization(False)
+    Main.AutoSave(sys_lch)
+    try:
+        asyncio.run(Serve(sys_lch, args.unix, args.host, args.port))
+    finally:
+        # 退出时自动保存
+        Main.QUIT()
+
+
+if __name__ == '__main__':
+    main()